@@ -0,0 +1,387 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Everything runs headless.  This has to happen before Qt is imported.
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'src', 'main', 'python')
+sys.path.insert(0, SRC_DIR)
+
+from pdfBackend import availableBackends, BACKENDS
+from PyQt5.QtCore import QMarginsF, QPointF, QRectF, QSizeF, Qt
+from PyQt5.QtGui import (
+    QColor,
+    QFont,
+    QGuiApplication,
+    QImage,
+    QPageLayout,
+    QPageSize,
+    QPainter,
+    QPainterPath,
+    QPdfWriter,
+    QPen,
+)
+
+# Bump this whenever the generated inputs change so results from different
+# versions of the suite aren't compared by accident.
+SUITE_VERSION = 1
+
+SEED = 1234
+
+PDF_INPUTS = ['text.pdf', 'vector.pdf', 'scan.pdf']
+IMAGE_INPUTS = ['large.png', 'large.jpg']
+
+# Output size as a multiple of the input size
+SCALES = [2, 4]
+
+LAYOUTS = {
+    'letter-portrait': (QPageSize.Letter, QPageLayout.Portrait, 36),
+    'a3-landscape': (QPageSize.A3, QPageLayout.Landscape, 18),
+}
+
+PDF_MODES = ['vector', 'generatePDFFromPDF', 'raster', 'raster-stream']
+IMAGE_MODES = ['raster', 'raster-stream']
+
+# JPEGs can also be passed through without being decoded
+JPEG_MODES = ['vector'] + IMAGE_MODES
+
+# Modes which copy the input across with a PDF backend rather than
+# rasterizing it.  These are run once per backend.
+BACKEND_MODES = ['vector', 'generatePDFFromPDF']
+
+def _makePdfWriter(fileName):
+    writer = QPdfWriter(fileName)
+    writer.setPageSize(QPageSize(QPageSize.Letter))
+    writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+    writer.setResolution(72)
+    writer.setCreator('pdfXplode benchmark')
+    return writer
+
+
+def _makeTextPDF(fileName, rand, numPages):
+    words = ['poster', 'explode', 'tile', 'margin', 'registration',
+             'render', 'vector', 'page', 'print', 'crop', 'scale']
+    writer = _makePdfWriter(fileName)
+    painter = QPainter(writer)
+    painter.setFont(QFont('Sans', 6))
+    for page in range(numPages):
+        if page > 0:
+            writer.newPage()
+        for line in range(100):
+            text = ' '.join(rand.choice(words) for i in range(24))
+            painter.drawText(QPointF(20, 20 + line * 7.5), text)
+    painter.end()
+
+
+def _makeVectorPDF(fileName, rand, numPages):
+    writer = _makePdfWriter(fileName)
+    painter = QPainter(writer)
+    painter.setRenderHint(QPainter.Antialiasing, True)
+    for page in range(numPages):
+        if page > 0:
+            writer.newPage()
+        for i in range(4000):
+            path = QPainterPath()
+            path.moveTo(rand.uniform(0, 612), rand.uniform(0, 792))
+            for j in range(4):
+                path.cubicTo(rand.uniform(0, 612), rand.uniform(0, 792),
+                             rand.uniform(0, 612), rand.uniform(0, 792),
+                             rand.uniform(0, 612), rand.uniform(0, 792))
+            color = QColor(rand.randrange(256), rand.randrange(256),
+                           rand.randrange(256), 128)
+            painter.setPen(QPen(color, rand.uniform(0.1, 2)))
+            painter.drawPath(path)
+    painter.end()
+
+
+def _makeScanImage(width, height, rand):
+    # Something with enough detail that it doesn't compress to nothing but
+    # which doesn't take forever to generate pixel by pixel.
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(QColor(240, 236, 226))
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing, True)
+    for i in range(width * height // 4000):
+        gray = rand.randrange(64, 224)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor(gray, gray, gray))
+        size = rand.uniform(2, width / 40)
+        painter.drawEllipse(QRectF(rand.uniform(0, width),
+                                   rand.uniform(0, height), size, size))
+    painter.setPen(QColor(20, 20, 20))
+    painter.setFont(QFont('Serif', max(8, height // 150)))
+    for line in range(0, height, max(12, height // 100)):
+        painter.drawText(QPointF(width / 20, line), 'pdfXplode ' * 40)
+    painter.end()
+    return image
+
+
+def _makeScanPDF(fileName, rand, numPages):
+    writer = _makePdfWriter(fileName)
+    painter = QPainter(writer)
+    for page in range(numPages):
+        if page > 0:
+            writer.newPage()
+        # A letter page scanned at 200 DPI
+        image = _makeScanImage(1700, 2200, rand)
+        painter.drawImage(QRectF(0, 0, 612, 792), image)
+    painter.end()
+
+
+def generateInputs(inputDir, imageSize, numPages=3):
+    """Generates the synthetic inputs in inputDir if they aren't there"""
+    os.makedirs(inputDir, exist_ok=True)
+    stamp = os.path.join(inputDir, 'suite.json')
+    params = {
+        'version': SUITE_VERSION,
+        'imageSize': imageSize,
+        'numPages': numPages,
+    }
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            if json.load(f) == params:
+                return
+
+    generators = [
+        ('text.pdf', _makeTextPDF),
+        ('vector.pdf', _makeVectorPDF),
+        ('scan.pdf', _makeScanPDF),
+    ]
+    for name, generator in generators:
+        generator(os.path.join(inputDir, name), random.Random(SEED), numPages)
+
+    image = _makeScanImage(imageSize[0], imageSize[1], random.Random(SEED))
+    image.save(os.path.join(inputDir, 'large.png'))
+    image.save(os.path.join(inputDir, 'large.jpg'), quality=90)
+
+    with open(stamp, 'w') as f:
+        json.dump(params, f)
+
+
+def makeCases(inputs=None, scales=SCALES, layouts=LAYOUTS, modes=None,
+              backends=None):
+    cases = []
+    for inputName in inputs or PDF_INPUTS + IMAGE_INPUTS:
+        if inputName.endswith('.pdf'):
+            inputModes = PDF_MODES
+        elif inputName.endswith('.jpg'):
+            inputModes = JPEG_MODES
+        else:
+            inputModes = IMAGE_MODES
+        for scale, layout, mode in itertools.product(scales, layouts,
+                                                     inputModes):
+            if modes and mode not in modes:
+                continue
+            case = {
+                'input': inputName,
+                'scale': scale,
+                'layout': layout,
+                'mode': mode,
+            }
+            if mode in BACKEND_MODES:
+                for backend in backends or availableBackends():
+                    cases.append(dict(case, backend=backend))
+            else:
+                cases.append(case)
+    return cases
+
+
+def caseName(case):
+    name = '{input}-{scale}x-{layout}-{mode}'.format(**case)
+    if 'backend' in case:
+        name += '-' + case['backend']
+    return name
+
+
+def _peakRSS():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss # Already bytes
+    return rss * 1024
+
+
+def runCase(case, inputDir, outputDir):
+    """Runs a single case in this process and returns its measurements
+
+    This should be the only thing the process does or the peak RSS is
+    meaningless.  Use runCaseInSubprocess().
+    """
+    from inputImage import InputImage
+    from inputPDF import InputPDFFile
+    from outputPDF import generatePDFFromPDF, printInputImage
+    from PyQt5.QtPrintSupport import QPrinter
+
+    app = QGuiApplication([sys.argv[0]])
+
+    inFileName = os.path.join(inputDir, case['input'])
+    outFileName = os.path.join(outputDir, caseName(case) + '.pdf')
+
+    startTime = time.perf_counter()
+    if inFileName.endswith('.pdf'):
+        inPage = InputPDFFile(inFileName).getPage(1)
+    else:
+        inPage = InputImage(inFileName)
+    loadTime = time.perf_counter() - startTime
+
+    size = QSizeF(inPage.getSize())
+    cropRect = QRectF(0, 0, size.width(), size.height())
+    outSize = size * case['scale']
+    pageSizeId, orientation, margin = LAYOUTS[case['layout']]
+    pageLayout = QPageLayout(QPageSize(pageSizeId), orientation,
+                             QMarginsF(margin, margin, margin, margin),
+                             QPageLayout.Point)
+
+    startTime = time.perf_counter()
+    if case['mode'] == 'generatePDFFromPDF':
+        generatePDFFromPDF(outFileName, inPage, cropRect, outSize,
+                           pageLayout, True, True,
+                           pdfBackend=case.get('backend'))
+    else:
+        printer = QPrinter()
+        printer.setColorMode(QPrinter.Color)
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        printer.setOutputFileName(outFileName)
+        printer.setPageLayout(pageLayout)
+        printInputImage(printer, inPage, cropRect, outSize, True, True,
+                        streamTiles=case['mode'] == 'raster-stream',
+                        rasterize=case['mode'] != 'vector',
+                        pdfBackend=case.get('backend'))
+    wallTime = time.perf_counter() - startTime
+
+    result = dict(case)
+    result.update({
+        'loadTime': loadTime,
+        'wallTime': wallTime,
+        'peakRSS': _peakRSS(),
+        'outputBytes': os.path.getsize(outFileName),
+    })
+    return result
+
+
+def runCaseInSubprocess(case, inputDir, outputDir):
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-case',
+           json.dumps(case), '--input-dir', inputDir,
+           '--output-dir', outputDir]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    return json.loads(proc.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def _formatBytes(n):
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} GiB'.format(n)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pdfXplode export paths on synthetic '
+                    'inputs.  Each case runs in a fresh process so peak '
+                    'RSS is per case.')
+    parser.add_argument('--input-dir', default=None,
+                        help='where to generate and keep the inputs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output-dir', default=None,
+                        help='where to write the exploded PDFs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--quick', action='store_true',
+                        help='small inputs and a single scale and layout')
+    parser.add_argument('--input', action='append', dest='inputs',
+                        choices=PDF_INPUTS + IMAGE_INPUTS,
+                        help='only run this input (may be repeated)')
+    parser.add_argument('--mode', action='append', dest='modes',
+                        choices=PDF_MODES,
+                        help='only run this mode (may be repeated)')
+    parser.add_argument('--backend', action='append', dest='backends',
+                        choices=list(BACKENDS),
+                        help='only run the copying modes with this PDF '
+                             'backend (may be repeated, default: all the '
+                             'ones installed)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run each case this many times and keep the '
+                             'fastest')
+    parser.add_argument('--json', default=None, metavar='FILE',
+                        help='also write the results to FILE')
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        result = runCase(json.loads(args.run_case), args.input_dir,
+                         args.output_dir)
+        print(json.dumps(result))
+        return 0
+
+    tmpDir = tempfile.TemporaryDirectory(prefix='pdfXplode-bench-')
+    inputDir = args.input_dir or os.path.join(tmpDir.name, 'inputs')
+    outputDir = args.output_dir or os.path.join(tmpDir.name, 'outputs')
+    os.makedirs(outputDir, exist_ok=True)
+
+    if args.quick:
+        imageSize = (3000, 2000)
+        cases = makeCases(args.inputs, SCALES[:1], list(LAYOUTS)[:1],
+                          args.modes, args.backends)
+    else:
+        imageSize = (8000, 6000)
+        cases = makeCases(args.inputs, modes=args.modes,
+                          backends=args.backends)
+
+    app = QGuiApplication([sys.argv[0]])
+    sys.stderr.write('Generating inputs in {}\n'.format(inputDir))
+    generateInputs(inputDir, imageSize)
+
+    results = []
+    header = '{:<60} {:>9} {:>9} {:>11} {:>11}'.format(
+             'case', 'load (s)', 'wall (s)', 'peak RSS', 'output')
+    print(header)
+    print('-' * len(header))
+    for case in cases:
+        runs = [runCaseInSubprocess(case, inputDir, outputDir)
+                for i in range(max(1, args.repeat))]
+        result = min(runs, key=lambda r: r['wallTime'])
+        results.append(result)
+        print('{:<60} {:>9.3f} {:>9.3f} {:>11} {:>11}'.format(
+              caseName(case), result['loadTime'], result['wallTime'],
+              _formatBytes(result['peakRSS']),
+              _formatBytes(result['outputBytes'])))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'suiteVersion': SUITE_VERSION,
+                'python': sys.version,
+                'platform': sys.platform,
+                'imageSize': imageSize,
+                'results': results,
+            }, f, indent=1)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
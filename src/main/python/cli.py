@@ -0,0 +1,459 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import os
+import sys
+
+# We never show any widgets so there's no reason to talk to a window
+# system.  This has to happen before the QGuiApplication is created.
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from inputPDF import InputPDFFile, parsePageRange, PDFMetadata
+from inputImage import InputImage
+from jobScheduler import (
+    DEFAULT_MEMORY_BUDGET,
+    estimateExplodeMemory,
+    estimatePDFExplodeMemory,
+    explodeToPDF,
+    Job,
+    JobScheduler,
+)
+from pdfBackend import availableBackends, BACKEND_NAMES, getBackend
+from PyQt5.QtCore import (
+    QCoreApplication,
+    QEventLoop,
+    QMarginsF,
+    QRectF,
+    QSizeF,
+)
+from PyQt5.QtGui import QGuiApplication, QPageLayout, QPageSize
+from renderCache import DEFAULT_DISK_BYTE_BUDGET, DiskRenderCache
+import tracing
+from units import *
+
+LENGTH_SUFFIXES = [
+    ('in', INCHES),
+    ('pt', POINTS),
+    ('px', PIXELS),
+    ('%', PERCENT),
+]
+
+def parseLength(text, unit=POINTS, percentBase=None):
+    """Parses a length such as "36in" or "150%" and returns it in unit"""
+    text = text.strip()
+    valueUnit = unit
+    for suffix, suffixUnit in LENGTH_SUFFIXES:
+        if text.endswith(suffix):
+            text = text[:-len(suffix)].strip()
+            valueUnit = suffixUnit
+            break
+
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid length: " + text)
+
+    if valueUnit == PERCENT:
+        if percentBase is None:
+            raise argparse.ArgumentTypeError("Percentages are not allowed here")
+        return value * percentBase / 100
+
+    try:
+        return value * getConversionFactor(valueUnit, unit)
+    except UnitConversionError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parsePageSize(name):
+    for attr in dir(QPageSize):
+        value = getattr(QPageSize, attr)
+        if attr.lower() == name.lower() and \
+           isinstance(value, QPageSize.PageSizeId):
+            return QPageSize(value)
+
+    raise argparse.ArgumentTypeError("Unknown page size: " + name)
+
+
+def parseCrop(text):
+    try:
+        x, y, w, h = (float(v) for v in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Crop must be X,Y,WIDTH,HEIGHT")
+    return QRectF(x, y, w, h)
+
+
+def _selectPages(numPages, pageNumber, pageRange):
+    if pageRange is not None:
+        try:
+            return parsePageRange(pageRange, numPages)
+        except ValueError as e:
+            raise RuntimeError(str(e))
+
+    if pageNumber < 1 or pageNumber > numPages:
+        raise RuntimeError("Page {} is out of range (1-{})".format(
+                           pageNumber, numPages))
+    return [pageNumber]
+
+
+def loadInput(fileName, pageNumber, pageRange=None, diskCache=None):
+    """Opens fileName and returns the list of input pages to explode
+
+    If pageRange is given, it takes precedence over pageNumber.  Images
+    only ever have the one page.  All the pages of a PDF share the one
+    parsed document and, if given, keep their renders in diskCache.
+    """
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == '.pdf':
+        inputPDF = InputPDFFile(fileName, diskCache=diskCache)
+        pageNumbers = _selectPages(inputPDF.getNumPages(), pageNumber,
+                                   pageRange)
+        return [inputPDF.getPage(n) for n in pageNumbers]
+    elif ext in ('.png', '.jpg', '.jpeg'):
+        return [InputImage(fileName)]
+    else:
+        raise RuntimeError("Unknown file extension")
+
+
+def makeArgParser():
+    parser = argparse.ArgumentParser(
+        prog='pdfXplode',
+        description='Blow up a PDF or image and split it into printable '
+                    'pages without starting the GUI.')
+    parser.add_argument('input', nargs='+',
+                        help='input PDF, PNG or JPEG file')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output PDF file, or output directory when '
+                             'given several inputs')
+    parser.add_argument('--batch', action='store_true',
+                        help='treat the output as a directory even for a '
+                             'single input')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='in batch mode, run at most this many files at '
+                             'once (default: one per CPU)')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='in batch mode, limit the estimated memory use '
+                             'of the files being run at once, in MiB '
+                             '(default: {})'.format(
+                             DEFAULT_MEMORY_BUDGET // (1024 * 1024)))
+    parser.add_argument('-p', '--page', type=int, default=1,
+                        help='page of the input PDF to explode (default: 1)')
+    parser.add_argument('--pages', default=None,
+                        help='explode a range of pages into one output, '
+                             'e.g. "1-3,5" or "all" (overrides --page)')
+    parser.add_argument('--crop', type=parseCrop, default=None,
+                        help='input crop as X,Y,WIDTH,HEIGHT in points for '
+                             'PDFs or pixels for images (default: the '
+                             'whole page)')
+    parser.add_argument('--width', default=None,
+                        help='output width, e.g. "36in", "2592pt" or '
+                             '"400%%" of the crop width')
+    parser.add_argument('--height', default=None,
+                        help='output height, e.g. "48in", "3456pt" or '
+                             '"400%%" of the crop height')
+    parser.add_argument('--page-size', type=parsePageSize,
+                        default=QPageSize(QPageSize.Letter),
+                        help='output page size, e.g. Letter or A4 '
+                             '(default: Letter)')
+    parser.add_argument('--landscape', action='store_true',
+                        help='use landscape output pages')
+    parser.add_argument('--margin', default='0.5in',
+                        help='output page margin (default: 0.5in)')
+    parser.add_argument('--over-draw', action='store_true',
+                        help='over-draw into the margin instead of trimming')
+    parser.add_argument('--no-registration-marks', action='store_true',
+                        help='do not draw registration marks')
+    parser.add_argument('--rasterize', action='store_true',
+                        help='rasterize PDF and JPEG input instead of '
+                             'copying it across as-is')
+    parser.add_argument('--cull', action='store_true',
+                        help='when copying PDF input across, drop whatever '
+                             'falls outside of each output page from its '
+                             'copy of the page content (bigger files that '
+                             'print faster)')
+    parser.add_argument('--optimize', action='store_true',
+                        help='merge duplicate objects and compress any '
+                             'uncompressed streams in the output once it is '
+                             'written')
+    parser.add_argument('--pdf-backend', choices=BACKEND_NAMES, default=None,
+                        help='library used to copy PDF input across: '
+                             '"auto" picks the fastest one installed, '
+                             'though pikepdf keeps the whole output in '
+                             'memory until it is written out at the end '
+                             '(default: pypdf2, available: {})'.format(
+                             ', '.join(availableBackends())))
+    parser.add_argument('--stream-tiles', action='store_true',
+                        help='when rasterizing, render each page on its own '
+                             'to bound memory use by one sheet')
+    parser.add_argument('--render-processes', type=int, default=None,
+                        help='when rasterizing, render pages in this many '
+                             'worker processes (0 means one per CPU)')
+    parser.add_argument('--render-cache', default=None, metavar='DIR',
+                        help='keep rendered PDF pages in DIR so exploding '
+                             'the same input again skips rendering')
+    parser.add_argument('--render-cache-size', type=int, default=None,
+                        help='limit the size of the --render-cache '
+                             'directory in MiB (default: {})'.format(
+                             DEFAULT_DISK_BYTE_BUDGET // (1024 * 1024)))
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='record how long each stage of the export takes '
+                             'and write it to FILE')
+    parser.add_argument('--trace-format', choices=tracing.TRACE_FORMATS,
+                        default='chrome',
+                        help='format of the --trace file: a Chrome trace '
+                             'or plain JSON with per-job totals '
+                             '(default: chrome)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report progress')
+    return parser
+
+
+def _outputGeometry(args, pageSize):
+    # The crop and output size are worked out from the first page and
+    # applied to all of them, same as in the UI.
+    cropRect = args.crop
+    if cropRect is None:
+        cropRect = QRectF(0, 0, pageSize.width(), pageSize.height())
+
+    outWidth = None
+    if args.width is not None:
+        outWidth = parseLength(args.width, percentBase=cropRect.width())
+    outHeight = None
+    if args.height is not None:
+        outHeight = parseLength(args.height, percentBase=cropRect.height())
+
+    # Like the linked DimWidget in the UI, we keep the aspect ratio of the
+    # crop if only one output dimension is given.
+    if outWidth is None and outHeight is None:
+        outWidth = cropRect.width()
+        outHeight = cropRect.height()
+    elif outWidth is None:
+        outWidth = outHeight * cropRect.width() / cropRect.height()
+    elif outHeight is None:
+        outHeight = outWidth * cropRect.height() / cropRect.width()
+
+    return cropRect, QSizeF(outWidth, outHeight)
+
+
+def _explodeFile(inFileName, outFileName, args, pageLayout, progress=None,
+                 diskCache=None):
+    inPages = loadInput(inFileName, args.page, args.pages, diskCache)
+    cropRect, outSize = _outputGeometry(args, inPages[0].getSize())
+    return explodeToPDF(outFileName, inPages, cropRect, outSize, pageLayout,
+                        trim=not args.over_draw,
+                        registrationMarks=not args.no_registration_marks,
+                        progress=progress, streamTiles=args.stream_tiles,
+                        processes=args.render_processes, rasterize=args.rasterize,
+                        cull=args.cull, optimize=args.optimize,
+                        pdfBackend=args.pdf_backend)
+
+
+def _estimateJobMemory(inFileName, args, pageLayout):
+    # Sizes up a batch job from what can be had without opening the input
+    # properly.  The job opens it for real once it's its turn, so we never
+    # pay for that twice or hold hundreds of documents while they wait.
+    ext = os.path.splitext(inFileName)[1].lower()
+    if ext == '.pdf':
+        metadata = PDFMetadata(inFileName)
+        try:
+            pageNumbers = _selectPages(metadata.getNumPages(), args.page,
+                                       args.pages)
+            pageSize = metadata.getPageSizeF(pageNumbers[0]).toSize()
+        finally:
+            metadata.close()
+        cropRect, outSize = _outputGeometry(args, pageSize)
+        return estimatePDFExplodeMemory(inFileName, outSize, pageLayout,
+                                        args.stream_tiles, args.rasterize)
+    else:
+        # Opening an image only reads its header
+        inPages = loadInput(inFileName, args.page, args.pages)
+        cropRect, outSize = _outputGeometry(args, inPages[0].getSize())
+        return estimateExplodeMemory(inPages, outSize, pageLayout,
+                                     args.stream_tiles, args.rasterize)
+
+
+def batchOutputNames(inFileNames, outDir):
+    """Returns the output file name in outDir for each input file name
+
+    The inputs' directory layout is mirrored below the directory they all
+    have in common, so a/x.pdf and b/x.pdf don't both become x.pdf, and
+    inputs which only differ by extension get it added to their name.
+    Raises RuntimeError if two inputs would still end up in the same file.
+    """
+    paths = [os.path.abspath(f) for f in inFileNames]
+    try:
+        commonDir = os.path.commonpath([os.path.dirname(p) for p in paths])
+        stems = [os.path.splitext(os.path.relpath(p, commonDir))[0]
+                 for p in paths]
+    except ValueError:
+        # Different drives on Windows
+        stems = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+
+    counts = collections.Counter(os.path.normcase(stem) for stem in stems)
+    outFileNames = []
+    for path, stem in zip(paths, stems):
+        if counts[os.path.normcase(stem)] > 1:
+            # x.pdf and x.jpg
+            stem += '-' + os.path.splitext(path)[1][1:]
+        outFileNames.append(os.path.join(outDir, stem + '.pdf'))
+
+    seen = {}
+    for inFileName, outFileName in zip(inFileNames, outFileNames):
+        other = seen.setdefault(os.path.normcase(outFileName), inFileName)
+        if other is not inFileName:
+            raise RuntimeError("{} and {} would both be written to {}".format(
+                               other, inFileName, outFileName))
+    return outFileNames
+
+
+def _runBatch(args, pageLayout, diskCache=None):
+    outFileNames = batchOutputNames(args.input, args.output)
+    os.makedirs(args.output, exist_ok=True)
+
+    memoryBudget = DEFAULT_MEMORY_BUDGET
+    if args.memory_budget is not None:
+        memoryBudget = args.memory_budget * 1024 * 1024
+    scheduler = JobScheduler(args.jobs, memoryBudget)
+
+    def jobFinished(job):
+        if job.status == Job.FAILED:
+            sys.stderr.write('{}: failed\n{}'.format(job.name, job.error))
+        elif not args.quiet:
+            sys.stderr.write('{}: {} in {:.1f}s ({} KiB)\n'.format(
+                             job.name, job.status, job.elapsed(),
+                             job.lastBytesWritten // 1024))
+            if job.result:
+                sys.stderr.write('{}: optimizing saved {} KiB\n'.format(
+                                 job.name, job.result // 1024))
+    scheduler.jobFinished.connect(jobFinished)
+
+    failed = 0
+    for inFileName, outFileName in zip(args.input, outFileNames):
+        os.makedirs(os.path.dirname(outFileName), exist_ok=True)
+
+        try:
+            with tracing.job(inFileName):
+                memoryCost = _estimateJobMemory(inFileName, args, pageLayout)
+        except Exception as e:
+            # Whatever is wrong with one file shouldn't stop the batch
+            sys.stderr.write('{}: {}\n'.format(inFileName, e))
+            failed += 1
+            continue
+
+        scheduler.submit(Job(_explodeFile, inFileName, outFileName, args,
+                             pageLayout, name=inFileName,
+                             memoryCost=memoryCost, diskCache=diskCache))
+
+    if not scheduler.isIdle():
+        loop = QEventLoop()
+        scheduler.idle.connect(loop.quit)
+        loop.exec_()
+
+    stats = scheduler.stats()
+    if not args.quiet:
+        sys.stderr.write('{} finished, {} failed in {:.1f}s '
+                         '({:.2f} jobs/s, {} KiB/s)\n'.format(
+                         stats['finished'], stats['failed'] + failed,
+                         stats['elapsed'], stats['jobsPerSecond'],
+                         int(stats['bytesPerSecond'] // 1024)))
+
+    return 1 if stats['failed'] or failed else 0
+
+
+def _run(parser, args):
+    try:
+        margin = parseLength(args.margin)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    try:
+        # Fail now rather than in every job if it isn't installed
+        getBackend(args.pdf_backend)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.landscape:
+        orientation = QPageLayout.Landscape
+    else:
+        orientation = QPageLayout.Portrait
+    pageLayout = QPageLayout(args.page_size, orientation,
+                             QMarginsF(margin, margin, margin, margin),
+                             QPageLayout.Point)
+
+    diskCache = None
+    if args.render_cache is not None:
+        byteBudget = DEFAULT_DISK_BYTE_BUDGET
+        if args.render_cache_size is not None:
+            byteBudget = args.render_cache_size * 1024 * 1024
+        try:
+            diskCache = DiskRenderCache(args.render_cache, byteBudget)
+        except OSError as e:
+            parser.error("Cannot use render cache: {}".format(e))
+
+    if len(args.input) > 1 or args.batch:
+        try:
+            return _runBatch(args, pageLayout, diskCache)
+        except RuntimeError as e:
+            parser.error(str(e))
+
+    inFileName = args.input[0]
+
+    def progress(p, bytesWritten=None):
+        if not args.quiet:
+            sys.stderr.write('\r{}: {}%'.format(inFileName, p))
+            if bytesWritten is not None:
+                sys.stderr.write(' ({} KiB written)'.format(
+                                 bytesWritten // 1024))
+            if p >= 100:
+                sys.stderr.write('\n')
+            sys.stderr.flush()
+        return True
+
+    try:
+        with tracing.job(inFileName):
+            saved = _explodeFile(inFileName, args.output, args, pageLayout,
+                                 progress, diskCache)
+    except (RuntimeError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+
+    if args.optimize and not args.quiet:
+        sys.stderr.write('{}: optimizing saved {} KiB\n'.format(
+                         inFileName, saved // 1024))
+    return 0
+
+
+def main(argv=None):
+    parser = makeArgParser()
+    args = parser.parse_args(argv)
+
+    QCoreApplication.setOrganizationName("jlekstrand.net")
+    QCoreApplication.setOrganizationDomain("jlekstrand.net")
+    QCoreApplication.setApplicationName("pdfXtract")
+
+    app = QGuiApplication([sys.argv[0]])
+
+    if args.trace:
+        tracing.enable()
+
+    try:
+        return _run(parser, args)
+    finally:
+        if args.trace:
+            tracing.write(args.trace, args.trace_format)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
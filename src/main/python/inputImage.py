@@ -13,22 +13,105 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import os
-from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QPoint, QRect, QSize, QSizeF
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader
+from renderCache import DEFAULT_BYTE_BUDGET, RenderCache
 import shutil
+import struct
 import tempfile
+import threading
+import tracing
 import units
 
+# What we need to know about a JPEG to embed it in a PDF as-is
+JPEGInfo = collections.namedtuple('JPEGInfo',
+                                  ['width', 'height', 'components', 'adobe'])
+
+# Start-of-frame markers for baseline, extended and progressive Huffman
+# coded JPEGs.  These are the ones every PDF reader's DCTDecode handles.
+JPEG_SOF_MARKERS = (0xc0, 0xc1, 0xc2)
+
+def _readJPEGInfo(f):
+    # Walks the JPEG markers up to the start of frame.  Returns None if
+    # this isn't a JPEG we can pass through.
+    if f.read(2) != b'\xff\xd8':
+        return None
+
+    adobe = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] == 0xff:
+            # Fill byte
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd9:
+            # Markers without a length
+            continue
+
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        segment = f.read(length - 2)
+        if len(segment) < length - 2:
+            return None
+
+        if marker[1] == 0xee and segment.startswith(b'Adobe'):
+            # Adobe CMYK JPEGs store inverted values
+            adobe = True
+        elif 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8,
+                                                             0xcc):
+            if marker[1] not in JPEG_SOF_MARKERS:
+                return None
+            bits, height, width, components = \
+                struct.unpack('>BHHB', segment[:6])
+            if bits != 8 or components not in (1, 3, 4):
+                return None
+            return JPEGInfo(width, height, components, adobe)
+
+
 class InputImage(object):
-    def __init__(self, fileName):
-        # Make a copy of the file in a temporary directory.  This way we
-        # can reference it without worrying about the underlying file
-        # changing.
-        self._qImage = QImage()
-        self._qImage.load(fileName)
+    def __init__(self, fileName, renderCacheBudget=DEFAULT_BYTE_BUDGET):
+        # Only the header is read here.  Pixels are decoded on demand at
+        # whatever size and region is asked for so a huge scan doesn't cost
+        # gigabytes just to show a thumbnail.  This means the file must not
+        # change while it's open.
+        self.fileName = fileName
+
+        # Decoded images keyed by (size, region)
+        self.renderCache = RenderCache(renderCacheBudget)
+
+        # For formats which can't decode just a region, the one full decode
+        # that every region is cropped from.  This is usually far bigger
+        # than the render cache's budget so it's kept here instead until
+        # cleanup().
+        self._fullImageLock = threading.Lock()
+        self._fullImage = None
+
+        reader = QImageReader(fileName)
+        self._jpegInfo = None
+        if reader.format() == b'jpeg':
+            with open(fileName, 'rb') as f:
+                self._jpegInfo = _readJPEGInfo(f)
+        self._size = reader.size()
+        self._canClip = reader.supportsOption(QImageIOHandler.ClipRect)
+        if not self._size.isValid():
+            # Some formats don't know their size without decoding
+            if self._canClip:
+                image = self._decode(None, None)
+                self.renderCache.put(self._cacheKey(None, None), image)
+            else:
+                image = self._getFullImage()
+            self._size = image.size()
 
     def cleanup(self):
-        self._qImage = None
+        self.renderCache.clear()
+        with self._fullImageLock:
+            self._fullImage = None
 
     def getAllowedUnits(self):
         return [units.PIXELS]
@@ -37,7 +120,88 @@ class InputImage(object):
         return units.PIXELS
 
     def getSize(self):
-        return self._qImage.size()
+        return QSize(self._size)
+
+    def getSizeF(self):
+        return QSizeF(self._size)
+
+    def getJPEGInfo(self):
+        """Returns a JPEGInfo if the file can be embedded in a PDF as-is"""
+        return self._jpegInfo
+
+    def _decode(self, scaledSize, clipRect):
+        reader = QImageReader(self.fileName)
+        if clipRect is not None:
+            reader.setClipRect(clipRect)
+        if scaledSize is not None:
+            reader.setScaledSize(scaledSize)
+
+        with tracing.span('image.decode'):
+            image = reader.read()
+        if image.isNull():
+            raise RuntimeError("Failed to read {}: {}".format(
+                               self.fileName, reader.errorString()))
+        return image
+
+    def _getFullImage(self):
+        with self._fullImageLock:
+            if self._fullImage is None:
+                self._fullImage = self._decode(None, None)
+            return self._fullImage
+
+    def _cacheKey(self, scaledSize, clipRect):
+        key = ()
+        if scaledSize is not None:
+            key += (scaledSize.width(), scaledSize.height())
+        if clipRect is not None:
+            key += (clipRect.x(), clipRect.y(),
+                    clipRect.width(), clipRect.height())
+        return key
+
+    def getQImage(self, sizeHint=None, region=None, cache=True):
+        """Decodes the image, or part of it, to a QImage
+
+        If region is given, it is a QRectF in pixels and only that part of
+        the image is decoded.  sizeHint is the size of whatever is decoded.
+        Images are only ever scaled down here.  There's no point in
+        upsampling as the painter will scale as needed.  cache=False keeps
+        one-off decodes out of the render cache.
+        """
+        clipRect = None
+        size = self._size
+        if region is not None:
+            clipRect = region.toAlignedRect().intersected(
+                                            QRect(QPoint(0, 0), self._size))
+            size = clipRect.size()
+
+        scaledSize = None
+        if sizeHint is not None and \
+           sizeHint.width() < size.width() and \
+           sizeHint.height() < size.height():
+            scaledSize = sizeHint
+
+        key = self._cacheKey(scaledSize, clipRect)
+        if cache:
+            image = self.renderCache.get(key)
+            if image is not None:
+                return image
+
+        if clipRect is not None and not self._canClip:
+            # Formats like PNG can't skip anything so decoding a region
+            # means decoding the whole thing anyway.  Crop it out of the
+            # one full decode so that's only paid for once.
+            image = self._getFullImage().copy(clipRect)
+            if scaledSize is not None:
+                image = image.scaled(scaledSize)
+        elif not self._canClip and \
+             (scaledSize is None or self._fullImage is not None):
+            # Scaling what we already have beats decoding it all again
+            image = self._getFullImage()
+            if scaledSize is not None:
+                image = image.scaled(scaledSize)
+        else:
+            image = self._decode(scaledSize, clipRect)
 
-    def getQImage(self, sizeHint=None):
-        return self._qImage
+        if cache:
+            self.renderCache.put(key, image)
+        return image
@@ -13,16 +13,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import collections
+import hashlib
 import io
+import mmap
 import os
 import poppler
 import PyPDF2
+from renderCache import DEFAULT_BYTE_BUDGET, RenderCache
 from PyQt5.QtCore import QSize, QSizeF
 from PyQt5.QtGui import QImage
 import shutil
 import tempfile
+import threading
+import tracing
 import units
 
+# Number of resolved PyPDF2 page objects to keep around per document
+PYPDF2_PAGE_CACHE_SIZE = 32
+
+# Files at least this big are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
 POPPLER_TO_QT_FORMAT = {
     poppler.ImageFormat.invalid: QImage.Format_Invalid,
     poppler.ImageFormat.argb32: QImage.Format_ARGB32,
@@ -32,17 +44,68 @@ POPPLER_TO_QT_FORMAT = {
     poppler.ImageFormat.rgb24: QImage.Format_RGB888,
 }
 
+def parsePageRange(text, numPages):
+    """Parses a page range such as "1-3,5,8-" into a list of page numbers
+
+    Page numbers start at 1 and open-ended ranges run to the start or end
+    of the document.  "all" or an empty string means every page.  Raises
+    ValueError if the range is malformed or out of bounds.
+    """
+    text = text.strip()
+    if not text or text.lower() == 'all':
+        return list(range(1, numPages + 1))
+
+    pages = []
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = (v.strip() for v in part.split('-', 1))
+            first = int(first) if first else 1
+            last = int(last) if last else numPages
+        else:
+            first = last = int(part)
+
+        if first < 1 or last > numPages or first > last:
+            raise ValueError("Invalid page range: " + part)
+        pages.extend(range(first, last + 1))
+
+    return pages
+
+
+class PDFMetadata(object):
+    """The page count and page sizes of a PDF
+
+    This only parses the xref and the page tree, without reading the whole
+    file in or loading it into poppler, for when that's all that's needed.
+    """
+    def __init__(self, fileName):
+        self._file = open(fileName, 'rb')
+        try:
+            self._reader = PyPDF2.PdfFileReader(self._file, strict=False)
+        except:
+            self._file.close()
+            raise
+
+    def close(self):
+        self._reader = None
+        self._file.close()
+
+    def getNumPages(self):
+        return self._reader.getNumPages()
+
+    def getPageSizeF(self, pageNumber):
+        mediaBox = self._reader.getPage(pageNumber - 1).mediaBox
+        return QSizeF(float(mediaBox.getWidth()), float(mediaBox.getHeight()))
+
+
 class InputPDFPage(object):
     def __init__(self, pdfFile, pageNumber):
         self.pdfFile = pdfFile
         self.pageNumber = pageNumber
         self.page = pdfFile.doc.create_page(pageNumber - 1)
-        self._qImageSize = QSize(0, 0)
-        self._qImage = None
 
     def cleanup(self):
         self._page = None
-        self._qImage = None
 
     def getAllowedUnits(self):
         return [units.POINTS, units.INCHES]
@@ -51,7 +114,7 @@ class InputPDFPage(object):
         return units.POINTS
 
     def getPyPDF2PageObject(self):
-        return self.pdfFile.getPyPDF2Reader().getPage(self.pageNumber - 1)
+        return self.pdfFile.getPyPDF2Page(self.pageNumber)
 
     def getSizeF(self):
         rect = self.page.page_rect(poppler.PageBox.media_box)
@@ -61,28 +124,37 @@ class InputPDFPage(object):
     def getSize(self):
         return self.getSizeF().toSize()
 
-    def getQImage(self, sizeHint=None):
-        if sizeHint == None:
-            sizeHint = self.page.pageSize()
-
-        assert sizeHint.width() > 1 and sizeHint.height() > 1
-
-        if self._qImageSize != sizeHint:
-            self._qImage = None
-
+    def _renderQImage(self, sizeHint, region):
         renderer = poppler.PageRenderer()
         renderer.set_render_hint(poppler.RenderHint.antialiasing, True)
         renderer.set_render_hint(poppler.RenderHint.text_antialiasing, True)
         renderer.set_render_hint(poppler.RenderHint.text_hinting, True)
 
-        while self._qImage is None:
-            xDpi = (sizeHint.width() * 72) / self.getSizeF().width()
-            yDpi = (sizeHint.height() * 72) / self.getSizeF().height()
-            image = renderer.render_page(self.page, xDpi, yDpi)
+        while True:
+            if region is None:
+                xDpi = (sizeHint.width() * 72) / self.getSizeF().width()
+                yDpi = (sizeHint.height() * 72) / self.getSizeF().height()
+                renderArgs = (xDpi, yDpi)
+            else:
+                # Poppler takes the region to render in pixels at the
+                # requested resolution, relative to the top-left corner.
+                xDpi = (sizeHint.width() * 72) / region.width()
+                yDpi = (sizeHint.height() * 72) / region.height()
+                renderArgs = (xDpi, yDpi,
+                              round(region.x() * xDpi / 72),
+                              round(region.y() * yDpi / 72),
+                              sizeHint.width(), sizeHint.height())
+
+            # Poppler documents aren't safe to render from several threads
+            # at a time and the preview renders in the background.
+            with self.pdfFile.renderLock, \
+                 tracing.span('poppler.render', page=self.pageNumber):
+                image = renderer.render_page(self.page, *renderArgs)
 
-            qImage = QImage(image.data, image.width, image.height,
-                            image.bytes_per_row,
-                            POPPLER_TO_QT_FORMAT[image.format])
+            with tracing.span('qimage.construct'):
+                qImage = QImage(image.data, image.width, image.height,
+                                image.bytes_per_row,
+                                POPPLER_TO_QT_FORMAT[image.format])
 
             # If we ask Qt to import an image that's too large for it to
             # handle, it will return an empty 1x1 image rather than a null
@@ -91,27 +163,187 @@ class InputPDFPage(object):
                 sizeHint /= 2
                 continue
 
-            self._qImage = QImage(image.data, image.width, image.height,
-                                  image.bytes_per_row,
-                                  POPPLER_TO_QT_FORMAT[image.format])
-            self._qImageSize = sizeHint
+            return qImage
+
+    def getQImage(self, sizeHint=None, region=None, cache=True):
+        """Renders the page to a QImage
+
+        If region is given, it is a QRectF in points and only that part of
+        the page is rendered.  The returned image covers exactly region and
+        sizeHint is the pixel size of the region rather than the page.
+        Exports pass cache=False for the per-tile regions they'll only use
+        once to keep them from pushing the preview out of the render cache.
+        Those skip the disk cache too.
+        """
+        if sizeHint == None:
+            sizeHint = self.getSize()
+
+        assert sizeHint.width() > 1 and sizeHint.height() > 1
+
+        key = (self.pageNumber, sizeHint.width(), sizeHint.height())
+        if region is not None:
+            key += (region.x(), region.y(), region.width(), region.height())
+
+        renderCache = self.pdfFile.renderCache if cache else None
+        qImage = None
+        if renderCache is not None:
+            qImage = renderCache.get(key)
+        if qImage is None:
+            diskCache = self.pdfFile.diskCache if cache else None
+            if diskCache is not None:
+                # The resolution is implied by the size and region
+                diskKey = (self.pdfFile.getContentHash(),) + key
+                qImage = diskCache.get(diskKey)
+
+            if qImage is None:
+                qImage = self._renderQImage(sizeHint, region)
+                if diskCache is not None:
+                    diskCache.put(diskKey, qImage)
+
+            if renderCache is not None:
+                renderCache.put(key, qImage)
+
+        return qImage
+
+class _BufferStream(io.RawIOBase):
+    """A read-only file object over a buffer which does not copy it
+
+    io.BytesIO always takes its own copy of the data.  This lets PyPDF2
+    read straight out of a memory map with its own file position.
+    """
+    def __init__(self, buf):
+        super(_BufferStream, self).__init__()
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError("Invalid whence")
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        # The buffer can't be unmapped while we still have a view of it
+        if not self.closed:
+            self._view.release()
+        super(_BufferStream, self).close()
 
-        return self._qImage
 
 class InputPDFFile(object):
-    def __init__(self, fileName):
-        # Read the entire file because we'll need to open it with multiple
-        # different PDF libraries
-        with open(fileName, 'rb') as f:
-            self.bytes = f.read()
+    def __init__(self, fileName, renderCacheBudget=DEFAULT_BYTE_BUDGET,
+                 diskCache=None):
+        self.fileName = fileName
+
+        # Rendered pages shared by the preview and printing, keyed by
+        # (page, resolution, region)
+        self.renderCache = RenderCache(renderCacheBudget)
+        self.renderLock = threading.Lock()
 
-        self.doc = poppler.document.load_from_data(self.bytes)
+        # An optional DiskRenderCache which persists renders across
+        # sessions.  Those are keyed by the content of the file as well.
+        self.diskCache = diskCache
+        self._contentHashLock = threading.Lock()
+        self._contentHash = None
+
+        if os.path.getsize(fileName) < MMAP_THRESHOLD:
+            # Read the entire file because we'll need to open it with
+            # multiple different PDF libraries
+            with open(fileName, 'rb') as f:
+                self.bytes = f.read()
+
+            self.doc = poppler.document.load_from_data(self.bytes)
+        else:
+            # Big files are mapped instead so we don't hold a private copy
+            # in every library.  PyPDF2 reads the mapping directly and
+            # poppler reads the file through its own stream because
+            # load_from_data() would copy the buffer into a std::vector.
+            # This means we no longer have a snapshot of the file and it
+            # must not be modified while it's open.
+            with open(fileName, 'rb') as f:
+                self.bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            self.doc = poppler.document.load_from_file(fileName)
+
+        # Parsing the xref and trailer of a large document is expensive so
+        # we only do it once and keep the most recently used pages around.
+        # Exports may happen on another thread so guard all of it.
+        self._pyPDF2Lock = threading.Lock()
+        self._pyPDF2Reader = None
+        self._pyPDF2Pages = collections.OrderedDict()
+
+        # Documents opened by the PDF backends, keyed by backend name
+        self._backendLock = threading.Lock()
+        self._backendDocs = {}
+
+        # Every _BufferStream handed out over self.bytes
+        self._streams = []
+
+    def _openStream(self):
+        stream = _BufferStream(self.bytes)
+        self._streams.append(stream)
+        return stream
 
     def cleanup(self):
-        self.tmpDir.cleanup()
-        self.tmpDir = None
-        self.tmpFileName = None
-        self.pdfReader = None
+        self.renderCache.clear()
+        with self._pyPDF2Lock, self._backendLock:
+            self._pyPDF2Reader = None
+            self._pyPDF2Pages.clear()
+            self._backendDocs.clear()
+
+            # The readers are gone so nothing should read the mapping
+            # again.  Anything that does gets a ValueError from its stream
+            # rather than a crash.
+            for stream in self._streams:
+                stream.close()
+            self._streams = []
+            if isinstance(self.bytes, mmap.mmap):
+                try:
+                    self.bytes.close()
+                except BufferError:
+                    # Someone still has a view of it.  It'll be unmapped
+                    # when that goes away.
+                    pass
+
+    def getContentHash(self):
+        """Returns a hex digest of the contents of the file
+
+        This reads the whole file so it's only worked out the first time
+        it's needed.
+        """
+        with self._contentHashLock:
+            if self._contentHash is None:
+                with tracing.span('pdf.contentHash'):
+                    self._contentHash = hashlib.sha256(self.bytes).hexdigest()
+            return self._contentHash
 
     def getNumPages(self):
         return self.doc.pages
@@ -119,5 +351,34 @@ class InputPDFFile(object):
     def getPage(self, pageNumber):
         return InputPDFPage(self, pageNumber)
 
+    def _getPyPDF2ReaderLocked(self):
+        if self._pyPDF2Reader is None:
+            self._pyPDF2Reader = PyPDF2.PdfFileReader(self._openStream())
+        return self._pyPDF2Reader
+
     def getPyPDF2Reader(self):
-        return PyPDF2.PdfFileReader(io.BytesIO(self.bytes))
+        with self._pyPDF2Lock:
+            return self._getPyPDF2ReaderLocked()
+
+    def getBackendDocument(self, backend):
+        """Returns this file opened by the PDFBackend backend"""
+        with self._backendLock:
+            doc = self._backendDocs.get(backend.name)
+            if doc is None:
+                doc = backend.openDocument(self._openStream())
+                self._backendDocs[backend.name] = doc
+            return doc
+
+    def getPyPDF2Page(self, pageNumber):
+        with self._pyPDF2Lock:
+            page = self._pyPDF2Pages.get(pageNumber)
+            if page is not None:
+                self._pyPDF2Pages.move_to_end(pageNumber)
+                return page
+
+            reader = self._getPyPDF2ReaderLocked()
+            page = reader.getPage(pageNumber - 1)
+            self._pyPDF2Pages[pageNumber] = page
+            if len(self._pyPDF2Pages) > PYPDF2_PAGE_CACHE_SIZE:
+                self._pyPDF2Pages.popitem(last=False)
+            return page
@@ -0,0 +1,352 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+from inputImage import InputImage
+from inputPDF import InputPDFPage, MMAP_THRESHOLD
+import math
+import os
+from outputPDF import canCopyToPDF, printInputPages, ThreadedOperation
+from pdfOptimize import optimizePDF
+from PyQt5.QtCore import QObject, QThreadPool, pyqtSignal
+from PyQt5.QtPrintSupport import QPrinter
+import time
+import traceback
+import tracing
+
+# Default total memory estimate of all the jobs allowed to run at once
+DEFAULT_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+# Physical resolution QPrinter() rasterizes at for PDF output
+DEFAULT_PRINTER_DPI = 1200
+
+def explodeToPDF(fileName, inPages, cropRect, outSize, pageLayout,
+                 trim=False, registrationMarks=False, progress=None,
+                 streamTiles=False, processes=None, rasterize=False,
+                 cull=False, optimize=False, pdfBackend=None):
+    """Explodes inPages to the PDF file fileName
+
+    This creates its own QPrinter so it can be run from any thread.  If
+    optimize is set, the output is run through optimizePDF() afterwards and
+    the number of bytes that saved is returned.
+    """
+    printer = QPrinter()
+    printer.setColorMode(QPrinter.Color)
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    printer.setOutputFileName(fileName)
+    printer.setPageLayout(pageLayout)
+
+    printInputPages(printer, inPages, cropRect, outSize, trim,
+                    registrationMarks, progress, streamTiles, processes,
+                    rasterize, cull, pdfBackend)
+
+    saved = 0
+    if optimize and os.path.exists(fileName):
+        with tracing.span('pdf.optimize'):
+            saved = optimizePDF(fileName)
+    return saved
+
+
+def estimateExplodeMemory(inPages, outSize, pageLayout, streamTiles=False,
+                          rasterize=False, dpi=DEFAULT_PRINTER_DPI):
+    """Returns a rough estimate of the peak bytes used by explodeToPDF()"""
+    inPage = inPages[0]
+    cost = 0
+
+    if isinstance(inPage, InputPDFPage):
+        # The input is read into memory unless it's big enough to be mapped
+        fileSize = len(inPage.pdfFile.bytes)
+        if fileSize < MMAP_THRESHOLD:
+            cost += fileSize
+    elif inPage.getJPEGInfo() is not None:
+        # Only if it's passed through, but then it's read in whole
+        cost += os.path.getsize(inPage.fileName)
+
+    if not rasterize and all(canCopyToPDF(p) for p in inPages):
+        # Nothing gets rasterized
+        return cost
+
+    if isinstance(inPage, InputImage):
+        # Images are never decoded any bigger than they are, however big
+        # the output.  On top of the decode, each sheet gets its own crop.
+        size = inPage.getSize()
+        native = size.width() * size.height() * 4
+        tile = min(_rasterMemory(outSize, pageLayout, True, dpi), native)
+        if streamTiles:
+            return cost + tile
+        full = min(_rasterMemory(outSize, pageLayout, False, dpi), native)
+        return cost + full + tile
+
+    return cost + _rasterMemory(outSize, pageLayout, streamTiles, dpi)
+
+
+def estimatePDFExplodeMemory(fileName, outSize, pageLayout,
+                             streamTiles=False, rasterize=False,
+                             dpi=DEFAULT_PRINTER_DPI):
+    """Like estimateExplodeMemory() for a PDF file which hasn't been opened
+
+    This is for sizing up a job before it runs without paying for opening
+    the file twice.
+    """
+    cost = 0
+    fileSize = os.path.getsize(fileName)
+    if fileSize < MMAP_THRESHOLD:
+        cost += fileSize
+
+    if not rasterize:
+        return cost
+
+    return cost + _rasterMemory(outSize, pageLayout, streamTiles, dpi)
+
+
+def _rasterMemory(outSize, pageLayout, streamTiles, dpi):
+    if streamTiles:
+        # One sheet at a time
+        size = pageLayout.fullRectPoints().size()
+    else:
+        size = outSize
+
+    pixels = (size.width() * dpi / 72) * (size.height() * dpi / 72)
+    return math.ceil(pixels * 4)
+
+
+class Job(QObject):
+    """One operation queued up in a JobScheduler
+
+    func is called on a worker thread with args, kwargs and a progress
+    callback, just like ThreadedOperation.  Higher priority jobs are started
+    first and jobs with the same priority are started in the order they
+    were submitted.  memoryCost is an estimate of the peak number of bytes
+    the job will use and is counted against the scheduler's budget.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    CANCELED = 'canceled'
+    FAILED = 'failed'
+
+    progress = pyqtSignal(int)
+    bytesWritten = pyqtSignal('qint64')
+    finished = pyqtSignal(object)
+
+    def __init__(self, func, *args, name=None, priority=0, memoryCost=0,
+                 **kwargs):
+        super(Job, self).__init__()
+        self.name = name
+        self.priority = priority
+        self.memoryCost = memoryCost
+        self.status = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.lastBytesWritten = 0
+        self.startTime = None
+        self.endTime = None
+
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._scheduler = None
+        self._op = None
+
+    def _run(self, progress=None):
+        # Catch everything here.  Otherwise a single bad file would leave the
+        # job running forever as far as the scheduler is concerned.
+        try:
+            with tracing.job(self.name):
+                return (True, self._func(*self._args, progress=progress,
+                                         **self._kwargs))
+        except Exception:
+            return (False, traceback.format_exc())
+
+    def _setBytesWritten(self, bytesWritten):
+        self.lastBytesWritten = bytesWritten
+        self.bytesWritten.emit(bytesWritten)
+
+    def _start(self, threadPool):
+        self.status = Job.RUNNING
+        self.startTime = time.monotonic()
+        self._op = ThreadedOperation(self._run)
+        self._op.progress.connect(self.progress)
+        self._op.bytesWritten.connect(self._setBytesWritten)
+        self._op.finished.connect(self._opFinished)
+        self._op.runInThread(threadPool)
+
+    def _opFinished(self, result):
+        self.endTime = time.monotonic()
+        ok, value = result
+        if self.status == Job.CANCELED:
+            pass
+        elif ok:
+            self.status = Job.FINISHED
+            self.result = value
+        else:
+            self.status = Job.FAILED
+            self.error = value
+        self._op = None
+        self._scheduler._jobDone(self)
+        self.finished.emit(self)
+
+    def elapsed(self):
+        if self.startTime is None:
+            return 0
+        endTime = self.endTime if self.endTime is not None else time.monotonic()
+        return endTime - self.startTime
+
+    def isDone(self):
+        return self.status in (Job.FINISHED, Job.CANCELED, Job.FAILED)
+
+    def cancel(self):
+        if self._scheduler is not None:
+            self._scheduler.cancel(self)
+
+
+class JobScheduler(QObject):
+    """Runs many Jobs on a dedicated thread pool
+
+    At most maxJobs jobs run at once, which defaults to one per CPU, and
+    the memoryCost of the running jobs is kept within memoryBudget.  A job
+    which is too big for the budget on its own still gets run, but only
+    when nothing else is.  The scheduler has its own thread pool so a big
+    batch doesn't starve the preview of threads.
+
+    Signals are delivered on the thread the scheduler lives on, which needs
+    to be running a Qt event loop.
+    """
+    jobStarted = pyqtSignal(object)
+    jobFinished = pyqtSignal(object)
+    idle = pyqtSignal()
+
+    def __init__(self, maxJobs=None, memoryBudget=DEFAULT_MEMORY_BUDGET,
+                 parent=None):
+        super(JobScheduler, self).__init__(parent)
+        if not maxJobs:
+            maxJobs = os.cpu_count() or 1
+
+        self._threadPool = QThreadPool(self)
+        self._threadPool.setMaxThreadCount(maxJobs)
+        self._memoryBudget = memoryBudget
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = set()
+        self._memoryUsed = 0
+
+        self._startTime = None
+        self._counts = {
+            Job.FINISHED: 0,
+            Job.CANCELED: 0,
+            Job.FAILED: 0,
+        }
+        self._bytesWritten = 0
+
+    def maxJobs(self):
+        return self._threadPool.maxThreadCount()
+
+    def memoryBudget(self):
+        return self._memoryBudget
+
+    def submit(self, job):
+        assert job._scheduler is None
+        job._scheduler = self
+        if self._startTime is None:
+            self._startTime = time.monotonic()
+        heapq.heappush(self._queue, (-job.priority, next(self._seq), job))
+        self._schedule()
+        return job
+
+    def cancel(self, job):
+        if job.status == Job.QUEUED:
+            # Left in the heap and skipped when it comes up
+            job.status = Job.CANCELED
+            self._counts[Job.CANCELED] += 1
+            job.finished.emit(job)
+            self.jobFinished.emit(job)
+            self._checkIdle()
+        elif job.status == Job.RUNNING:
+            job.status = Job.CANCELED
+            if job._op.cancel():
+                # It was still waiting for a thread so it won't finish on
+                # its own
+                job._opFinished((False, None))
+
+    def cancelAll(self):
+        for _, _, job in list(self._queue):
+            self.cancel(job)
+        for job in list(self._running):
+            self.cancel(job)
+
+    def _fits(self, job):
+        if not self._running:
+            return True
+        if len(self._running) >= self.maxJobs():
+            return False
+        return self._memoryUsed + job.memoryCost <= self._memoryBudget
+
+    def _schedule(self):
+        while self._queue:
+            job = self._queue[0][2]
+            if job.status == Job.CANCELED:
+                heapq.heappop(self._queue)
+                continue
+
+            # Strictly in priority order.  Skipping ahead to smaller jobs
+            # would starve the big ones.
+            if not self._fits(job):
+                break
+
+            heapq.heappop(self._queue)
+            self._running.add(job)
+            self._memoryUsed += job.memoryCost
+            job._start(self._threadPool)
+            self.jobStarted.emit(job)
+
+    def _jobDone(self, job):
+        self._running.discard(job)
+        self._memoryUsed -= job.memoryCost
+        self._counts[job.status] += 1
+        self._bytesWritten += job.lastBytesWritten
+        self.jobFinished.emit(job)
+        self._schedule()
+        self._checkIdle()
+
+    def _checkIdle(self):
+        if self.isIdle():
+            self.idle.emit()
+
+    def isIdle(self):
+        return not self._running and \
+               all(job.status == Job.CANCELED for _, _, job in self._queue)
+
+    def stats(self):
+        """Returns a dict of job counts and aggregate throughput"""
+        elapsed = 0
+        if self._startTime is not None:
+            elapsed = time.monotonic() - self._startTime
+        queued = sum(1 for _, _, job in self._queue
+                     if job.status == Job.QUEUED)
+        finished = self._counts[Job.FINISHED]
+        return {
+            'queued': queued,
+            'running': len(self._running),
+            'finished': finished,
+            'canceled': self._counts[Job.CANCELED],
+            'failed': self._counts[Job.FAILED],
+            'memoryUsed': self._memoryUsed,
+            'bytesWritten': self._bytesWritten,
+            'elapsed': elapsed,
+            'jobsPerSecond': finished / elapsed if elapsed else 0,
+            'bytesPerSecond': self._bytesWritten / elapsed if elapsed else 0,
+        }
@@ -0,0 +1,102 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+from outputPDF import ThreadedOperation
+from PyQt5.QtGui import QPixmap
+
+class LazyPixmaps(object):
+    """Pixmaps rendered in the background for whatever a view shows
+
+    Keys are whatever the view uses to tell its pieces apart.  request()
+    renders one on a thread pool and setVisible() cancels any still queued
+    which have gone out of view.  Finished renders are kept as QPixmaps,
+    dropping the least recently used ones once there are more than a
+    couple of screenfuls.  pixmapReady(key) is called as each one arrives
+    and pixmapDropped(key), if given, as each one is dropped.
+    """
+    def __init__(self, minPixmaps, pixmapReady, pixmapDropped=None,
+                 threadPool=None):
+        self._minPixmaps = minPixmaps
+        self._maxPixmaps = minPixmaps
+        self._pixmapReady = pixmapReady
+        self._pixmapDropped = pixmapDropped
+        self._threadPool = threadPool
+        self._pixmaps = collections.OrderedDict()
+        self._pendingOps = {}
+
+    def cancelAll(self):
+        for op in self._pendingOps.values():
+            op.cancel()
+        self._pendingOps = {}
+        self._pixmaps.clear()
+
+    def get(self, key):
+        """Returns the pixmap for key, or None if it isn't rendered"""
+        pixmap = self._pixmaps.get(key)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(key)
+        return pixmap
+
+    def isPending(self, key):
+        return key in self._pendingOps
+
+    def request(self, key, func, *args):
+        """Renders func(*args) on the thread pool as the pixmap for key
+
+        func gets a progress callback like any ThreadedOperation and
+        should return a QImage, or None if it was canceled.
+        """
+        if key in self._pendingOps:
+            return
+
+        op = ThreadedOperation(func, *args)
+        op.finished.connect(
+            lambda image, key=key, op=op: self._rendered(key, op, image))
+        self._pendingOps[key] = op
+        op.runInThread(self._threadPool)
+
+    def setVisible(self, keys):
+        """Tells us which keys are visible now"""
+        keys = set(keys)
+
+        # Anything still queued which has gone out of view is just wasted
+        # work now
+        for key in list(self._pendingOps.keys()):
+            if key not in keys:
+                self._pendingOps.pop(key).cancel()
+
+        # Keep enough to cover the view a couple times over so scrolling
+        # back and forth doesn't re-render
+        self._maxPixmaps = max(self._minPixmaps, 2 * len(keys))
+        self._trim()
+
+    def _trim(self):
+        while len(self._pixmaps) > self._maxPixmaps:
+            key, pixmap = self._pixmaps.popitem(last=False)
+            if self._pixmapDropped is not None:
+                self._pixmapDropped(key)
+
+    def _rendered(self, key, op, image):
+        if self._pendingOps.get(key) is not op:
+            return # Canceled
+
+        del self._pendingOps[key]
+        if image is None:
+            return
+
+        self._pixmaps[key] = QPixmap.fromImage(image)
+        self._trim()
+        self._pixmapReady(key)
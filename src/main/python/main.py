@@ -14,21 +14,59 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
-from inputPDF import InputPDFFile, InputPDFPage
+from inputPDF import InputPDFFile, InputPDFPage, parsePageRange
 from inputImage import InputImage
 import math
+import multiprocessing
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtPrintSupport import *
 from PyQt5.QtWidgets import *
 import os
-from outputPDF import ThreadedOperation, printInputImage
+from outputPDF import ThreadedOperation, printInputPages
+from pageThumbnails import PageThumbnailList
+from previewTiles import levelForScale, prefetchTiles, TiledPageItem
+from renderCache import DiskRenderCache
 import sys
 import tempfile
 from units import *
 
 MILE_IN_POINTS = 72 * 12 * 5280
 
+# Resolution of the quick first pass of the preview
+PREVIEW_DRAFT_DPI = 24
+
+# Number of pages either side of the current one whose preview is rendered
+# ahead of time
+PREFETCH_PAGES = 1
+
+def previewDraftSize(pageSize):
+    return QSize(max(2, (pageSize.width() * PREVIEW_DRAFT_DPI) // 72),
+                 max(2, (pageSize.height() * PREVIEW_DRAFT_DPI) // 72))
+
+
+def _renderDraft(inputPage, progress=None):
+    # The page may have been switched away from while this was queued
+    if progress and not progress(0):
+        return None
+    return inputPage.getQImage(previewDraftSize(inputPage.getSize()))
+
+
+def _prefetchPage(inputPage, level, rect, progress=None):
+    # The draft first since that's what shows up first
+    if _renderDraft(inputPage, progress) is not None:
+        prefetchTiles(inputPage, level, rect, progress)
+
+
+def _openPDF(fileName, diskCache, progress=None):
+    # Loading a big document reads the whole xref so it happens on the
+    # thread pool.  Errors are handed back to be reported on the UI thread.
+    try:
+        return InputPDFFile(fileName, diskCache=diskCache)
+    except Exception as e:
+        return e
+
+
 class UnitsComboBox(QComboBox):
     valueChanged = pyqtSignal(str)
 
@@ -270,7 +308,14 @@ class PreviewWidget(QGraphicsView):
         self.pageMargin = (0, 0)
 
         self.cropRectItem = None
-        self.pageRectItems = []
+        self.pageGridItem = None
+        self._rectsUpdatePending = False
+        self.tiledItem = None
+        self._draftOp = None
+
+        # Ctrl+wheel zooms around the mouse and dragging pans
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
 
         backgroundBrush = QBrush(Qt.gray)
         self.scene.setBackgroundBrush(backgroundBrush)
@@ -290,89 +335,145 @@ class PreviewWidget(QGraphicsView):
         self.pagePen.setJoinStyle(Qt.RoundJoin)
 
     def _reload(self):
+        if self.tiledItem:
+            self.tiledItem.cancelAll()
+        if self._draftOp:
+            self._draftOp.cancel()
+            self._draftOp = None
+
         self.scene.clear()
         self.image = None
+        self.pixmap = None
+        self.tiledItem = None
         self.cropRectItem = None
-        self.pageRectItems = []
+        self.pageGridItem = None
         if not self.inputPage:
             return
 
-        # We like 96 DPI
-        preferredSize = (self.inputPage.getSize() *
-                         96 * self.devicePixelRatio()) / 72
-        self.image = self.inputPage.getQImage(preferredSize)
-        self.pixmap = self.scene.addPixmap(QPixmap.fromImage(self.image))
+        # Render a quick low-resolution draft in the background so the UI
+        # stays responsive even if the first page is a huge scan.  It goes
+        # under the tiled item, which fills in sharp tiles for whatever is
+        # visible at the current zoom as they get rendered.
         pageSize = self.inputPage.getSize()
-        # Assume it scales the same in both directions
-        assert (pageSize.width() * self.image.height() ==
-                pageSize.height() * self.image.width())
-        self.pixmap.setScale(pageSize.width() / self.image.width())
+        op = ThreadedOperation(_renderDraft, self.inputPage)
+        op.finished.connect(
+            lambda image, op=op: self._draftRendered(op, image))
+        self._draftOp = op
+        op.runInThread()
+
+        self.tiledItem = TiledPageItem(self.inputPage)
+        self.scene.addItem(self.tiledItem)
+
         self.setSceneRect(QRectF(QRect(QPoint(0, 0), pageSize)))
         self.setTransform(QTransform().scale(96 / 72, 96 / 72))
 
+    def _draftRendered(self, op, image):
+        if op is not self._draftOp:
+            return # Canceled
+        self._draftOp = None
+        if image is None:
+            return
+
+        pageSize = self.inputPage.getSize()
+        self.image = image
+        self.pixmap = self.scene.addPixmap(QPixmap.fromImage(self.image))
+        self.pixmap.setZValue(-1)
+        # The draft may round differently in each direction
+        self.pixmap.setTransform(QTransform.fromScale(
+            pageSize.width() / self.image.width(),
+            pageSize.height() / self.image.height()))
+        self.pixmap.setTransformationMode(Qt.SmoothTransformation)
+
+    def visibleTiles(self):
+        """Returns the tile level and the part of the page that's in view"""
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(
+                    self.transform()) * self.devicePixelRatioF()
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        return levelForScale(scale), rect
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:
+            factor = 1.25 ** (event.angleDelta().y() / 120)
+            self.scale(factor, factor)
+            event.accept()
+        else:
+            super(PreviewWidget, self).wheelEvent(event)
+
     def setInputPage(self, page):
         if self.inputPage != page:
             self.inputPage = page
             self._reload()
             self._updateRects()
 
-    def _updateRects(self):
-        if self.cropRectItem:
-            self.scene.removeItem(self.cropRectItem)
-        self.cropRectItem = None
+    def _scheduleUpdateRects(self):
+        # A single edit can change several of our parameters, especially
+        # with linked DimWidgets, so only rebuild once per event loop pass.
+        if not self._rectsUpdatePending:
+            self._rectsUpdatePending = True
+            QTimer.singleShot(0, self._updateRects)
 
-        for r in self.pageRectItems:
-            self.scene.removeItem(r)
-        self.pageRectItems = []
+    def _updateRects(self):
+        self._rectsUpdatePending = False
 
         cropRect = QRectF(self.cropOrig[0], self.cropOrig[1],
                           self.cropSize[0], self.cropSize[1])
-        self.cropRectItem = self.scene.addRect(cropRect, pen=self.cropPen,
-                                               brush=QBrush(Qt.NoBrush))
+        if self.cropRectItem:
+            self.cropRectItem.setRect(cropRect)
+        else:
+            self.cropRectItem = self.scene.addRect(cropRect, pen=self.cropPen,
+                                                   brush=QBrush(Qt.NoBrush))
+
+        # The whole page grid is a single path item so that it doesn't
+        # matter how many pages there are.
+        gridPath = QPainterPath()
 
         printSize = (self.pageSize[0] - 2 * self.pageMargin[0],
                      self.pageSize[1] - 2 * self.pageMargin[1])
-        if printSize[0] == 0 or printSize[1] == 0:
-            return
-
-        numPagesX = math.ceil(self.outputSize[0] / printSize[0])
-        numPagesY = math.ceil(self.outputSize[1] / printSize[1])
-
-        if self.outputSize[0] == 0 or self.outputSize[1] == 0:
-            return
-
-        pageRectSize = (printSize[0] * self.cropSize[0] / self.outputSize[0],
-                        printSize[1] * self.cropSize[1] / self.outputSize[1])
-
-        for y in range(numPagesY):
-            for x in range(numPagesX):
-                pageRect = QRectF(self.cropOrig[0] + x * pageRectSize[0],
-                                  self.cropOrig[1] + y * pageRectSize[1],
-                                  pageRectSize[0],
-                                  pageRectSize[1])
-                rectItem = self.scene.addRect(pageRect, pen=self.pagePen,
-                                              brush=QBrush(Qt.NoBrush))
-                self.pageRectItems.append(rectItem)
+        if printSize[0] > 0 and printSize[1] > 0 and \
+           self.outputSize[0] > 0 and self.outputSize[1] > 0:
+            numPagesX = math.ceil(self.outputSize[0] / printSize[0])
+            numPagesY = math.ceil(self.outputSize[1] / printSize[1])
+
+            pageRectSize = (
+                printSize[0] * self.cropSize[0] / self.outputSize[0],
+                printSize[1] * self.cropSize[1] / self.outputSize[1])
+
+            left = self.cropOrig[0]
+            top = self.cropOrig[1]
+            right = left + numPagesX * pageRectSize[0]
+            bottom = top + numPagesY * pageRectSize[1]
+            for x in range(numPagesX + 1):
+                gridPath.moveTo(left + x * pageRectSize[0], top)
+                gridPath.lineTo(left + x * pageRectSize[0], bottom)
+            for y in range(numPagesY + 1):
+                gridPath.moveTo(left, top + y * pageRectSize[1])
+                gridPath.lineTo(right, top + y * pageRectSize[1])
+
+        if self.pageGridItem:
+            self.pageGridItem.setPath(gridPath)
+        else:
+            self.pageGridItem = self.scene.addPath(gridPath, pen=self.pagePen,
+                                                   brush=QBrush(Qt.NoBrush))
 
     def setCropOrig(self, x, y):
         self.cropOrig = (x, y)
-        self._updateRects()
+        self._scheduleUpdateRects()
 
     def setCropSize(self, width, height):
         self.cropSize = (width, height)
-        self._updateRects()
+        self._scheduleUpdateRects()
 
     def setOutputSize(self, width, height):
         self.outputSize = (width, height)
-        self._updateRects()
+        self._scheduleUpdateRects()
 
     def setPageSize(self, width, height):
         self.pageSize = (width, height)
-        self._updateRects()
+        self._scheduleUpdateRects()
 
     def setPageMargin(self, width, height):
         self.pageMargin = (width, height)
-        self._updateRects()
+        self._scheduleUpdateRects()
 
 
 def loadPageLayout(settings, name, default):
@@ -422,6 +523,11 @@ class MainWindow(QMainWindow):
         self.inputPDF = None
         self.inputPage = None
         self.inputPageNumber = 0
+        self._openOp = None
+
+        # Neighbouring pages being rendered ahead of time, keyed by page
+        # number, as (InputPDFPage, ThreadedOperation)
+        self._prefetched = {}
 
         self.openAction = QAction(QIcon.fromTheme('document-open'), '&Open')
         self.openAction.triggered.connect(self.openFileDialog)
@@ -432,10 +538,30 @@ class MainWindow(QMainWindow):
         self.quitAction = QAction(QIcon.fromTheme('application-exit'), '&Quit')
         self.quitAction.triggered.connect(self.close)
 
+        # Renders are kept on disk so reopening a big file is quick
+        self.diskCache = None
+        self.diskCacheAction = QAction('Cache Renders on &Disk')
+        self.diskCacheAction.setCheckable(True)
+        self.diskCacheAction.setChecked(
+            QSettings().value('render-cache/enabled', False, type=bool))
+        self.diskCacheAction.toggled.connect(self._diskCacheToggled)
+
         self._setupMenus()
 
+        # Shown while a document is being opened
+        self.openProgress = QProgressBar()
+        self.openProgress.setRange(0, 0)
+        self.openProgress.setMaximumWidth(160)
+        self.openProgress.setVisible(False)
+        self.statusBar().addPermanentWidget(self.openProgress)
+
         hLayout = QHBoxLayout()
 
+        # Page thumbnails, only shown for PDFs
+        self.thumbnails = PageThumbnailList()
+        self.thumbnails.setVisible(False)
+        hLayout.addWidget(self.thumbnails)
+
         # Preview widget
         self.preview = PreviewWidget()
         hLayout.addWidget(self.preview)
@@ -452,10 +578,21 @@ class MainWindow(QMainWindow):
         self.pageNumSpin.setMaximum(1)
         self.pageNumSpin.setValue(self.inputPageNumber)
         self.pageNumSpin.valueChanged.connect(self.setPageNumber)
+        self.thumbnails.pageSelected.connect(self.pageNumSpin.setValue)
+        self.printPages = QComboBox()
+        self.printPages.addItem('Print this page', 'current')
+        self.printPages.addItem('Print all pages', 'all')
+        self.printPages.addItem('Print page range', 'range')
+        self.printPages.currentIndexChanged.connect(self._printPagesChanged)
+        self.pageRange = QLineEdit()
+        self.pageRange.setPlaceholderText('e.g. 1-3,5')
+        self.pageRange.setVisible(False)
         pageNumBox = QGroupBox()
         pageNumBox.setTitle('Page Number')
-        layout = QHBoxLayout()
+        layout = QVBoxLayout()
         layout.addWidget(self.pageNumSpin)
+        layout.addWidget(self.printPages)
+        layout.addWidget(self.pageRange)
         pageNumBox.setLayout(layout)
         formLayout.addWidget(pageNumBox)
 
@@ -524,8 +661,27 @@ class MainWindow(QMainWindow):
         fileMenu.addAction(self.openAction)
         fileMenu.addAction(self.printAction)
         fileMenu.addSeparator()
+        fileMenu.addAction(self.diskCacheAction)
+        fileMenu.addSeparator()
         fileMenu.addAction(self.quitAction)
 
+    def _diskCacheToggled(self, enabled):
+        QSettings().setValue('render-cache/enabled', enabled)
+
+    def _getDiskCache(self):
+        if not self.diskCacheAction.isChecked():
+            return None
+
+        if self.diskCache is None:
+            cacheDir = QStandardPaths.writableLocation(
+                QStandardPaths.CacheLocation)
+            try:
+                self.diskCache = DiskRenderCache(os.path.join(cacheDir,
+                                                              'renders'))
+            except OSError:
+                return None # Not worth bothering anyone about
+        return self.diskCache
+
     def _updatePageSize(self):
         if self.inputPage is None:
             return
@@ -550,6 +706,27 @@ class MainWindow(QMainWindow):
         self.scale.setValues(size.width(), size.height())
         self.scale.setDisplayUnit(self.scaleUnits.value())
 
+    def _printPagesChanged(self, index):
+        self.pageRange.setVisible(self.printPages.currentData() == 'range')
+
+    def _getPrintPages(self):
+        if self.inputPDF is None:
+            return [self.inputPage]
+
+        mode = self.printPages.currentData()
+        if mode == 'current':
+            return [self.inputPage]
+
+        numPages = self.inputPDF.getNumPages()
+        if mode == 'all':
+            pageNumbers = range(1, numPages + 1)
+        else:
+            pageNumbers = parsePageRange(self.pageRange.text(), numPages)
+
+        # Reuse the page we already have open for the preview
+        return [self.inputPage if n == self.inputPageNumber
+                else self.inputPDF.getPage(n) for n in pageNumbers]
+
     def setPageNumber(self, pageNumber):
         if self.inputPDF is None:
             return # Only PDFs have page numbers
@@ -558,25 +735,114 @@ class MainWindow(QMainWindow):
             if self.inputPage is not None:
                 self.inputPage.cleanup()
             self.inputPageNumber = pageNumber
-            self.inputPage = self.inputPDF.getPage(pageNumber)
+            prefetched = self._prefetched.get(pageNumber)
+            if prefetched is not None:
+                self.inputPage = prefetched[0]
+            else:
+                self.inputPage = self.inputPDF.getPage(pageNumber)
             self.preview.setInputPage(self.inputPage)
             self._updatePageSize()
-
-    def loadPDF(self, fileName):
+            self.thumbnails.setCurrentPage(pageNumber)
+            self._prefetchNeighbours()
+
+    def _cancelPrefetch(self):
+        for page, op in self._prefetched.values():
+            op.cancel()
+        self._prefetched = {}
+
+    def _prefetchNeighbours(self):
+        # Stepping through pages one at a time is the common case so get
+        # the next and previous previews into the render cache early.  That
+        # includes the sharp tiles for the current view, assuming the pages
+        # are all about the same size.
+        level, rect = self.preview.visibleTiles()
+        numPages = self.inputPDF.getNumPages()
+        wanted = [n for n in range(self.inputPageNumber - PREFETCH_PAGES,
+                                   self.inputPageNumber + PREFETCH_PAGES + 1)
+                  if n != self.inputPageNumber and 1 <= n <= numPages]
+
+        prefetched = {}
+        for n in wanted:
+            if n in self._prefetched:
+                prefetched[n] = self._prefetched.pop(n)
+            else:
+                page = self.inputPDF.getPage(n)
+                op = ThreadedOperation(_prefetchPage, page, level, rect)
+                op.runInThread()
+                prefetched[n] = (page, op)
+        self._cancelPrefetch()
+        self._prefetched = prefetched
+
+    def _closeInput(self):
+        self._openOp = None
+        self._cancelPrefetch()
+        if self.inputPage is not None:
+            self.inputPage.cleanup()
         if self.inputPDF:
             self.inputPDF.cleanup()
-        self.inputPDF = InputPDFFile(fileName)
+        self.inputPDF = None
         self.inputPage = None
+        self.preview.setInputPage(None)
+        self.thumbnails.setPDFFile(None)
+        self.thumbnails.setVisible(False)
+
+    def _setOpening(self, fileName):
+        opening = fileName is not None
+        if opening:
+            self.statusBar().showMessage(
+                'Opening {}...'.format(os.path.basename(fileName)))
+        else:
+            self.statusBar().clearMessage()
+        self.openProgress.setVisible(opening)
+        self.pageNumSpin.setDisabled(opening)
+        self.printPages.setDisabled(opening)
+        self.printAction.setDisabled(opening)
+        self.saveButton.setDisabled(opening)
+
+    def loadPDF(self, fileName):
+        """Opens fileName in the background
+
+        The window stays responsive while the document loads.  Once it has
+        been parsed, the page count and thumbnails show up right away and
+        the preview of the first page streams in after that.
+        """
+        self._closeInput()
+        self._setOpening(fileName)
+
+        op = ThreadedOperation(_openPDF, fileName, self._getDiskCache())
+        op.finished.connect(
+            lambda result, op=op: self._pdfOpened(op, fileName, result))
+        self._openOp = op
+        op.runInThread()
+
+    def _pdfOpened(self, op, fileName, result):
+        if op is not self._openOp:
+            # Something else was opened in the meantime
+            if isinstance(result, InputPDFFile):
+                result.cleanup()
+            return
+
+        self._openOp = None
+        self._setOpening(None)
+        if isinstance(result, Exception):
+            QMessageBox.warning(self, 'Cannot open file',
+                                '{}: {}'.format(fileName, result))
+            return
+
+        self.inputPDF = result
         self.pageNumSpin.setDisabled(False)
         self.pageNumSpin.setMaximum(self.inputPDF.getNumPages())
+        self.printPages.setDisabled(False)
+        self.thumbnails.setPDFFile(self.inputPDF)
+        self.thumbnails.setVisible(self.inputPDF.getNumPages() > 1)
         self.setPageNumber(self.pageNumSpin.value())
 
     def loadImage(self, fileName):
-        if self.inputPDF:
-            self.inputPDF.cleanup()
-        self.inputPDF = None
+        self._closeInput()
+        self._setOpening(None)
         self.inputPage = InputImage(fileName)
         self.pageNumSpin.setDisabled(True)
+        self.printPages.setDisabled(True)
         self.preview.setInputPage(self.inputPage)
         self._updatePageSize()
 
@@ -587,15 +853,25 @@ class MainWindow(QMainWindow):
         if not fname or not fname[0]:
             return # Canceled
 
-        ext = os.path.splitext(fname[0])[1].lower()
+        self.loadFile(fname[0])
+
+    def loadFile(self, fileName):
+        ext = os.path.splitext(fileName)[1].lower()
         if ext == '.pdf':
-            self.loadPDF(fname[0])
+            self.loadPDF(fileName)
         elif ext in ('.png', '.jpg'):
-            self.loadImage(fname[0])
+            self.loadImage(fileName)
         else:
-            raise RuntimeError("Unknown file extension")
+            QMessageBox.warning(self, 'Cannot open file',
+                                '{}: Unknown file extension'.format(fileName))
 
     def printDialog(self):
+        try:
+            inPages = self._getPrintPages()
+        except ValueError as e:
+            QMessageBox.warning(self, 'Invalid page range', str(e))
+            return
+
         settings = QSettings()
 
         printer = QPrinter()
@@ -609,13 +885,13 @@ class MainWindow(QMainWindow):
                                     defaultPageLayout)
         printer.setPageLayout(pageLayout)
 
-        cropRect = QRect(*self.cropOrig.values(), *self.cropDim.values())
-        outSize = QSize(*self.scale.values())
+        cropRect = QRectF(*self.cropOrig.values(), *self.cropDim.values())
+        outSize = QSizeF(*self.scale.values())
         trim = not self.overDraw.isChecked()
         registrationMarks = self.registrationMarks.isChecked()
 
         def paintPreview(printer):
-            printInputImage(printer, self.inputPage, cropRect,
+            printInputPages(printer, inPages, cropRect,
                             outSize, trim, registrationMarks)
 
         preview = QPrintPreviewDialog(printer)
@@ -625,6 +901,15 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == '__main__':
+    # Parallel rendering spawns worker processes from this executable
+    multiprocessing.freeze_support()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'explode':
+        # We're being run as a batch tool.  Hand off to the headless CLI
+        # before we create any widgets.
+        import cli
+        sys.exit(cli.main(sys.argv[2:]))
+
     QCoreApplication.setOrganizationName("jlekstrand.net")
     QCoreApplication.setOrganizationDomain("jlekstrand.net")
     QCoreApplication.setApplicationName("pdfXtract")
@@ -640,4 +925,11 @@ if __name__ == '__main__':
 
     window = MainWindow(ctx)
     window.show()
+
+    # Opening a file with us from a file manager passes it as an argument.
+    # Qt has already taken out any options of its own.
+    fileNames = ctx.app.arguments()[1:]
+    if fileNames:
+        window.loadFile(fileNames[0])
+
     sys.exit(ctx.app.exec_())
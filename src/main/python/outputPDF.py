@@ -15,11 +15,12 @@
 
 from inputPDF import InputPDFPage
 from inputImage import InputImage
-import io
 import math
 import os
-import PyPDF2
-from PyQt5.QtCore import QPoint, QRect, QSize
+from parallelTiles import iterTileImages
+from pdfBackend import getBackend
+from pdfCull import CullableContents, parseContents
+from PyQt5.QtCore import QLineF, QPoint, QPointF, QRect, QRectF, QSize, QSizeF
 from PyQt5.QtCore import (
     pyqtSignal,
     Qt,
@@ -31,7 +32,6 @@ from PyQt5.QtCore import (
     Q_ARG
 )
 from PyQt5.QtGui import (
-    QBrush,
     QPageLayout,
     QPageSize,
     QPainter,
@@ -39,27 +39,30 @@ from PyQt5.QtGui import (
     QTransform,
 )
 from PyQt5.QtPrintSupport import QPrinter
-import tempfile
+import traceback
+import tracing
 
-def _paintWhiteBorder(printer, painter):
-    page = printer.pageLayout().fullRectPoints()
-    margin = printer.pageLayout().marginsPoints()
+# Extra pixels kept around each page's part of the image when cropping it so
+# the printer has something to filter with right up to the edge
+TILE_BLEED_PIXELS = 2
 
-    painter.save()
-    painter.setBrush(QBrush(Qt.white))
-    painter.setPen(QPen(Qt.NoPen))
-    painter.drawRect(0, 0, margin.left(), page.height())
-    painter.drawRect(0, 0, page.width(), margin.top())
-    painter.drawRect(page.width() - margin.right(), 0,
-                     margin.right(), page.height())
-    painter.drawRect(0, page.height() - margin.bottom(),
-                     page.width(), margin.bottom())
-    painter.restore()
+def _whiteBorderRects(pageLayout):
+    page = pageLayout.fullRectPoints()
+    margin = pageLayout.marginsPoints()
 
+    return [
+        QRectF(0, 0, margin.left(), page.height()),
+        QRectF(0, 0, page.width(), margin.top()),
+        QRectF(page.width() - margin.right(), 0,
+               margin.right(), page.height()),
+        QRectF(0, page.height() - margin.bottom(),
+               page.width(), margin.bottom()),
+    ]
 
-def _paintRegistrationMarks(printer, painter):
-    page = printer.pageLayout().fullRectPoints()
-    margin = printer.pageLayout().marginsPoints()
+
+def _registrationMarkLines(pageLayout):
+    page = pageLayout.fullRectPoints()
+    margin = pageLayout.marginsPoints()
 
     # Get ourselves some nice abbreviations
     pw = page.width()
@@ -73,6 +76,19 @@ def _paintRegistrationMarks(printer, painter):
     # running into the main page area
     cf = 0.9
 
+    return [
+        QLineF(0, mt, ml * cf, mt),
+        QLineF(ml, 0, ml, mt * cf),
+        QLineF(pw, mt, pw - mr * cf, mt),
+        QLineF(pw - mr, 0, pw - mr, mt * cf),
+        QLineF(0, ph - mb, ml * cf, ph - mb),
+        QLineF(ml, ph, ml, ph - mb * cf),
+        QLineF(pw, ph - mb, pw - mr * cf, ph - mb),
+        QLineF(pw - mr, ph, pw - mr, ph - mb * cf),
+    ]
+
+
+def _paintRegistrationMarks(printer, painter):
     pen = QPen()
     pen.setStyle(Qt.SolidLine)
     pen.setWidth(1)
@@ -80,14 +96,7 @@ def _paintRegistrationMarks(printer, painter):
 
     painter.save()
     painter.setPen(pen)
-    painter.drawLine(0, mt, ml * cf, mt)
-    painter.drawLine(ml, 0, ml, mt * cf)
-    painter.drawLine(pw, mt, pw - mr * cf, mt)
-    painter.drawLine(pw - mr, 0, pw - mr, mt * cf)
-    painter.drawLine(0, ph - mb, ml * cf, ph - mb)
-    painter.drawLine(ml, ph, ml, ph - mb * cf)
-    painter.drawLine(pw, ph - mb, pw - mr * cf, ph - mb)
-    painter.drawLine(pw - mr, ph, pw - mr, ph - mb * cf)
+    painter.drawLines(_registrationMarkLines(printer.pageLayout()))
     painter.restore()
 
 
@@ -103,8 +112,8 @@ def _makePainter(printer):
 
     pageSizePoints = printer.pageLayout().fullRectPoints().size()
     pageSizeLogical = QSize(
-        (pageSizePoints.width() * printer.logicalDpiX()) / 72,
-        (pageSizePoints.height() * printer.logicalDpiY()) / 72)
+        round((pageSizePoints.width() * printer.logicalDpiX()) / 72),
+        round((pageSizePoints.height() * printer.logicalDpiY()) / 72))
 
     painter.setWindow(QRect(QPoint(0, 0), pageSizePoints))
     painter.setViewport(QRect(QPoint(0, 0), pageSizeLogical))
@@ -112,138 +121,339 @@ def _makePainter(printer):
     return painter
 
 
-def printOverlayPage(printer, trim=False, registrationMarks=False):
-    painter = _makePainter(printer)
-
-    if trim:
-        _paintWhiteBorder(printer, painter)
-
-    if registrationMarks:
-        _paintRegistrationMarks(printer, painter)
+def _tileSourceRect(inPage, cropRect, outSize, drawRect):
+    # Maps drawRect, given in output points relative to the top-left corner
+    # of the blown-up output, back to the part of the input page it shows.
+    # The result is rounded out to whole input units and clamped to the
+    # page so it can be handed straight to getQImage().
+    sx = cropRect.width() / outSize.width()
+    sy = cropRect.height() / outSize.height()
+    srcRect = QRectF(cropRect.x() + drawRect.x() * sx,
+                     cropRect.y() + drawRect.y() * sy,
+                     drawRect.width() * sx,
+                     drawRect.height() * sy)
+    pageRect = QRectF(QPointF(0, 0), QSizeF(inPage.getSize()))
+    return QRectF(srcRect.toAlignedRect()).intersected(pageRect)
 
-    painter.end()
 
-
-def printInputImage(printer, inPage, cropRect, outSize,
-                    trim=False, registrationMarks=False,
-                    progress=None):
-    if printer.outputFormat() == QPrinter.PdfFormat and \
-       printer.outputFileName() and isinstance(inPage, InputPDFPage):
-        # In this case, we're outputting a PDF from another PDF.  We can
-        # output a higher quality PDF if we do it manually with PyPDF2.
-        printer.abort()
-        generatePDFFromPDF(printer.outputFileName(), inPage, cropRect, outSize,
-                           printer.pageLayout(), trim, registrationMarks,
-                           progress)
-        return
-
-    painter = _makePainter(printer)
-
-    fullRect = printer.pageLayout().fullRectPoints()
-    margin = printer.pageLayout().marginsPoints()
+def _tileGrid(pageLayout, outSize):
+    fullRect = pageLayout.fullRectPoints()
+    margin = pageLayout.marginsPoints()
 
     printableWidth = fullRect.width() - margin.left() - margin.right()
     printableHeight = fullRect.height() - margin.top() - margin.bottom()
 
     numPagesX = math.ceil(outSize.width() / printableWidth)
     numPagesY = math.ceil(outSize.height() / printableHeight)
-    numPages = numPagesX * numPagesY
 
-    imageSizeHint = QSize(
-        (inPage.getSize().width() *
-         painter.device().physicalDpiX() *
-         outSize.width()) /
-        (cropRect.width() * 72),
-        (inPage.getSize().height() *
-         painter.device().physicalDpiY() *
-         outSize.height()) /
-        (cropRect.height() * 72))
+    return (fullRect, margin, printableWidth, printableHeight,
+            numPagesX, numPagesY)
 
-    image = inPage.getQImage(imageSizeHint)
-
-    for y in range(numPagesY):
-        for x in range(numPagesX):
-            percentComplete = ((numPagesX * y + x) * 100) // numPages
-            if progress and not progress(percentComplete):
-                printer.abort()
-                return
 
-            if x > 0 or y > 0:
-                if not printer.newPage():
-                    raise RuntimeError("Failed to flush the page")
-
-            if registrationMarks:
-                _paintRegistrationMarks(printer, painter)
-
-            painter.save()
+def _tileDrawRect(pageLayout, trim, x, y):
+    # The part of the blown-up output which ends up on page (x, y), in
+    # output points relative to its top-left corner
+    fullRect = pageLayout.fullRectPoints()
+    margin = pageLayout.marginsPoints()
+    printableWidth = fullRect.width() - margin.left() - margin.right()
+    printableHeight = fullRect.height() - margin.top() - margin.bottom()
 
-            if trim:
-                painter.setClipRect(margin.left(), margin.top(),
-                                    printableWidth, printableHeight)
+    if trim:
+        drawRect = QRectF(0, 0, printableWidth, printableHeight)
+    else:
+        drawRect = QRectF(-margin.left(), -margin.top(),
+                          fullRect.width(), fullRect.height())
+    drawRect.translate(x * printableWidth, y * printableHeight)
+    return drawRect
 
-            painter.translate(margin.left(), margin.top())
-            painter.translate(-x * printableWidth, -y * printableHeight)
-            painter.scale(outSize.width() / cropRect.width(),
-                          outSize.height() / cropRect.height())
-            painter.translate(-cropRect.x(), -cropRect.y())
 
-            painter.scale(inPage.getSize().width() / image.size().width(),
-                          inPage.getSize().height() / image.size().height())
-            painter.drawImage(0, 0, image)
+def _renderTileImage(inPage, region, sizeHint):
+    with tracing.span('render.tile'):
+        return inPage.getQImage(sizeHint, region, cache=False)
 
-            painter.restore()
 
-    painter.end()
+def printInputImage(printer, inPage, cropRect, outSize,
+                    trim=False, registrationMarks=False,
+                    progress=None, streamTiles=False, processes=None,
+                    rasterize=False, cull=False, pdfBackend=None):
+    """Prints inPage, blown up to outSize and split into pages, to printer
 
-    if progress:
-        progress(100)
+    PDF and JPEG input going to a PDF file is copied across as-is unless
+    rasterize is set.  See canCopyToPDF() and generatePDFFromPDFPages() for
+    what cull and pdfBackend do.
 
+    If streamTiles is set, only the part of the input visible on each page
+    is rendered, one page at a time, at the printer's full resolution.  This
+    bounds peak memory by the size of one sheet rather than the whole
+    poster.
 
-def generatePDFFromPDF(fileName, inPage, cropRect, outSize,
-                       pageLayout, trim=False, registrationMarks=False,
-                       progress=None):
-    assert isinstance(inPage, InputPDFPage)
-    inReaderPage = inPage.getPyPDF2PageObject()
+    If processes is not None, pages are rendered the same way but in a
+    pool of that many worker processes, each with its own copy of the
+    input.  Zero means one per CPU.
+    """
+    printInputPages(printer, [inPage], cropRect, outSize, trim,
+                    registrationMarks, progress, streamTiles, processes,
+                    rasterize, cull, pdfBackend)
 
-    overlayPage = None
-    if trim or registrationMarks:
-        with tempfile.TemporaryDirectory(prefix='pdfXplode-tmpPDF') as d:
-            # Print our trimming and registration marks to a temporary
-            # PDF so we can merge it with the input PDF.  Sadly,
-            # QPrinter has no way to print to an in-memory stream so we
-            # have to use a temporary file.
-            tmpFileName = os.path.join(d, 'overlay.pdf')
 
-            printer = QPrinter()
-            printer.setOutputFormat(QPrinter.PdfFormat)
-            printer.setOutputFileName(tmpFileName)
-            printer.setPageLayout(pageLayout)
-            printOverlayPage(printer, trim, registrationMarks)
+def printInputPages(printer, inPages, cropRect, outSize,
+                    trim=False, registrationMarks=False,
+                    progress=None, streamTiles=False, processes=None,
+                    rasterize=False, cull=False, pdfBackend=None):
+    """Like printInputImage() but explodes each of inPages in turn
+
+    Everything goes to the one printer with a single progress stream.  The
+    page layout is worked out once and shared by all the pages.
+    """
+    if not rasterize and \
+       printer.outputFormat() == QPrinter.PdfFormat and \
+       printer.outputFileName() and \
+       all(canCopyToPDF(inPage) for inPage in inPages):
+        # In this case, we're outputting a PDF from another PDF or a JPEG.
+        # We can output a higher quality PDF if we copy the input across
+        # ourselves instead of rasterizing it.
+        printer.abort()
+        generatePDFFromPDFPages(printer.outputFileName(), inPages, cropRect,
+                                outSize, printer.pageLayout(), trim,
+                                registrationMarks, progress, cull,
+                                pdfBackend)
+        return
 
-            with open(tmpFileName, 'rb') as f:
-                overlayPDFBytes = f.read()
+    painter = _makePainter(printer)
 
-        reader = PyPDF2.PdfFileReader(io.BytesIO(overlayPDFBytes))
-        overlayPage = reader.getPage(0)
+    fullRect, margin, printableWidth, printableHeight, numPagesX, numPagesY = \
+        _tileGrid(printer.pageLayout(), outSize)
+    numTiles = numPagesX * numPagesY
+    numPages = numTiles * len(inPages)
+
+    # Device pixels per input unit
+    pixelsPerUnitX = ((painter.device().physicalDpiX() * outSize.width()) /
+                      (cropRect.width() * 72))
+    pixelsPerUnitY = ((painter.device().physicalDpiY() * outSize.height()) /
+                      (cropRect.height() * 72))
+
+    perTile = streamTiles or processes is not None
+    if perTile:
+        # Work out up-front which part of the input each page needs so we
+        # can hand them all off to the worker processes.
+        tiles = []
+        for inPage in inPages:
+            for y in range(numPagesY):
+                for x in range(numPagesX):
+                    drawRect = _tileDrawRect(printer.pageLayout(), trim,
+                                             x, y)
+                    srcRect = _tileSourceRect(inPage, cropRect, outSize,
+                                              drawRect)
+                    if srcRect.isEmpty():
+                        tiles.append(None)
+                        continue
+
+                    tileSizeHint = QSize(
+                        max(2, math.ceil(srcRect.width() * pixelsPerUnitX)),
+                        max(2, math.ceil(srcRect.height() * pixelsPerUnitY)))
+                    tiles.append((inPage, srcRect, tileSizeHint))
+
+        if processes is not None:
+            tileImages = iterTileImages(tiles, processes)
+        else:
+            tileImages = (_renderTileImage(*t) if t else None
+                          for t in tiles)
+
+    try:
+        for pageIndex, inPage in enumerate(inPages):
+            if not perTile:
+                imageSizeHint = QSize(
+                    round(inPage.getSize().width() * pixelsPerUnitX),
+                    round(inPage.getSize().height() * pixelsPerUnitY))
+
+                # Print previews repaint every page at the printer's
+                # resolution so these are worth caching.  The cache won't
+                # take anything too big for its budget.
+                with tracing.span('render.page'):
+                    image = inPage.getQImage(imageSizeHint)
+
+            for y in range(numPagesY):
+                for x in range(numPagesX):
+                    tileIndex = pageIndex * numTiles + numPagesX * y + x
+                    percentComplete = (tileIndex * 100) // numPages
+                    if progress and not progress(percentComplete):
+                        printer.abort()
+                        return
+
+                    if tileIndex > 0:
+                        with tracing.span('printer.newPage'):
+                            flushed = printer.newPage()
+                        if not flushed:
+                            raise RuntimeError("Failed to flush the page")
+
+                    if registrationMarks:
+                        _paintRegistrationMarks(printer, painter)
+
+                    painter.save()
+
+                    if trim:
+                        painter.setClipRect(margin.left(), margin.top(),
+                                            printableWidth, printableHeight)
+
+                    painter.translate(margin.left(), margin.top())
+                    painter.translate(-x * printableWidth,
+                                      -y * printableHeight)
+                    painter.scale(outSize.width() / cropRect.width(),
+                                  outSize.height() / cropRect.height())
+                    painter.translate(-cropRect.x(), -cropRect.y())
+
+                    if perTile:
+                        tileImage = next(tileImages)
+                        if tileImage is not None:
+                            with tracing.span('painter.drawImage'):
+                                painter.drawImage(tiles[tileIndex][1],
+                                                  tileImage)
+                        tileImage = None
+                    else:
+                        painter.scale(inPage.getSize().width() /
+                                      image.size().width(),
+                                      inPage.getSize().height() /
+                                      image.size().height())
+
+                        # Only hand the printer the pixels this page shows.
+                        # Otherwise a PDF printer embeds the whole poster
+                        # again on every page.
+                        srcRect = _tileSourceRect(
+                            inPage, cropRect, outSize,
+                            _tileDrawRect(printer.pageLayout(), trim, x, y))
+                        pixelRect = QTransform.fromScale(
+                            image.width() / inPage.getSize().width(),
+                            image.height() / inPage.getSize().height()
+                        ).mapRect(srcRect).toAlignedRect()
+                        pixelRect.adjust(-TILE_BLEED_PIXELS,
+                                         -TILE_BLEED_PIXELS,
+                                         TILE_BLEED_PIXELS,
+                                         TILE_BLEED_PIXELS)
+                        pixelRect = pixelRect.intersected(image.rect())
+                        if not pixelRect.isEmpty():
+                            with tracing.span('painter.drawImage'):
+                                painter.drawImage(pixelRect.topLeft(),
+                                                  image.copy(pixelRect))
+
+                    painter.restore()
+
+            image = None
+    finally:
+        if perTile:
+            # Cancels any tiles still being rendered if we bailed early
+            tileImages.close()
+
+    # This is where QPrinter writes out whatever it has left
+    with tracing.span('printer.end'):
+        painter.end()
 
-    fullRect = printer.pageLayout().fullRectPoints()
-    margin = printer.pageLayout().marginsPoints()
+    if progress:
+        # QPrinter doesn't say how much it wrote but it's all on disk now
+        fileName = printer.outputFileName()
+        if fileName and os.path.exists(fileName):
+            progress(100, os.path.getsize(fileName))
+        else:
+            progress(100)
+
+
+def _pdfNumber(value):
+    # PDF content streams want plain decimal numbers without exponents
+    s = '{:.6f}'.format(value).rstrip('0').rstrip('.')
+    return '0' if s in ('', '-0') else s
+
+
+def _makeSourceXObject(writer, inPage, data=None):
+    # Wraps the source page in a Form XObject so that every tile can draw
+    # it with a single Do operator instead of getting its own copy of the
+    # whole content stream.
+    if isinstance(inPage, InputPDFPage):
+        with tracing.span('pdf.formXObject', page=inPage.pageNumber):
+            return writer.addPageXObject(inPage, data)
+    else:
+        with tracing.span('pdf.jpegXObject'):
+            return writer.addJPEGXObject(inPage)
+
+
+def canCopyToPDF(inPage):
+    """Returns True if inPage can go into a PDF without being rasterized
+
+    That's any PDF page, which is copied across as vectors, and JPEGs,
+    which are embedded with their original compressed data.
+    """
+    if isinstance(inPage, InputPDFPage):
+        return True
+    return isinstance(inPage, InputImage) and inPage.getJPEGInfo() is not None
+
+
+def _makeOverlayXObject(writer, pageLayout, trim, registrationMarks):
+    # Builds the white border and registration marks as a Form XObject
+    # covering the whole output page.  This is the same thing Qt would draw
+    # for us but without printing to a temporary PDF and parsing it back.
+    pageHeight = pageLayout.fullRectPoints().height()
+
+    # Flip everything from Qt's top-down coordinates to PDF's bottom-up
+    def y(v):
+        return _pdfNumber(pageHeight - v)
+
+    ops = []
+    if trim:
+        ops.append('1 g')
+        for r in _whiteBorderRects(pageLayout):
+            ops.append(' '.join([_pdfNumber(r.x()), y(r.bottom()),
+                                 _pdfNumber(r.width()),
+                                 _pdfNumber(r.height())]) + ' re')
+        ops.append('f')
 
-    printableWidth = fullRect.width() - margin.left() - margin.right()
-    printableHeight = fullRect.height() - margin.top() - margin.bottom()
+    if registrationMarks:
+        ops.append('0 G 1 w')
+        for l in _registrationMarkLines(pageLayout):
+            ops.append(_pdfNumber(l.x1()) + ' ' + y(l.y1()) + ' m ' +
+                       _pdfNumber(l.x2()) + ' ' + y(l.y2()) + ' l')
+        ops.append('S')
 
-    numPagesX = math.ceil(outSize.width() / printableWidth)
-    numPagesY = math.ceil(outSize.height() / printableHeight)
-    numPages = numPagesX * numPagesY
+    fullRect = pageLayout.fullRectPoints()
+    return writer.addFormXObject('\n'.join(ops).encode('ascii'),
+                                 fullRect.width(), fullRect.height())
 
-    outPDF = PyPDF2.PdfFileWriter()
 
+def generatePDFFromPDF(fileName, inPage, cropRect, outSize,
+                       pageLayout, trim=False, registrationMarks=False,
+                       progress=None, cull=False, pdfBackend=None):
+    generatePDFFromPDFPages(fileName, [inPage], cropRect, outSize,
+                            pageLayout, trim, registrationMarks, progress,
+                            cull, pdfBackend)
+
+
+def generatePDFFromPDFPages(fileName, inPages, cropRect, outSize,
+                            pageLayout, trim=False, registrationMarks=False,
+                            progress=None, cull=False, pdfBackend=None):
+    """Writes the exploded inPages to the PDF fileName without rasterizing
+
+    All of inPages must pass canCopyToPDF().  Each input page goes in once
+    as a Form XObject which every output page showing part of it draws with
+    its own transform and clip.
+
+    The PDF is written by pdfBackend, which is the name of one of the
+    backends in pdfBackend.BACKENDS.  None means the default.
+
+    If cull is set, each output page instead gets its own copy of the
+    source page's content with everything that falls entirely outside of
+    that page removed, and is clipped to what it shows.  The output gets
+    bigger but each page is far less work for a printer to render.
+    """
+    assert all(canCopyToPDF(inPage) for inPage in inPages)
+
+    fullRect, margin, printableWidth, printableHeight, numPagesX, numPagesY = \
+        _tileGrid(pageLayout, outSize)
+    numTiles = numPagesX * numPagesY
+    numPages = numTiles * len(inPages)
+
+    # The tile transforms only depend on the page layout so work them out
+    # once for all the input pages.  All that's left per input page is the
+    # crop offset.
+    tileXforms = []
     for y in range(numPagesY):
         for x in range(numPagesX):
-            percentComplete = ((numPagesX * y + x) * 100) // (numPages + 1)
-            if progress and not progress(percentComplete):
-                return
-
             xt = x * printableWidth
             yt = y * printableHeight
 
@@ -256,7 +466,70 @@ def generatePDFFromPDF(fileName, inPage, cropRect, outSize,
             xform.translate(-xt, -yt)
             xform.scale(outSize.width() / cropRect.width(),
                         outSize.height() / cropRect.height())
-            xform.translate(-cropRect.x(), -cropRect.y())
+            tileXforms.append(xform)
+
+    writer = getBackend(pdfBackend).openWriter(fileName)
+
+    overlayXObject = None
+    if trim or registrationMarks:
+        # The trim and registration marks are the same on every page so we
+        # only need them once.
+        with tracing.span('pdf.overlay'):
+            overlayXObject = _makeOverlayXObject(writer, pageLayout, trim,
+                                                 registrationMarks)
+
+    # The part of each output page the source shows through on
+    if trim:
+        visibleRect = QRectF(margin.left(), margin.bottom(),
+                             printableWidth, printableHeight)
+    else:
+        visibleRect = QRectF(0, 0, fullRect.width(), fullRect.height())
+
+    xobjects = {}
+    if overlayXObject is not None:
+        xobjects['/pdfXplodeOverlay'] = overlayXObject
+
+    tileOps = ['/pdfXplodeSrc Do', 'Q']
+    if overlayXObject is not None:
+        tileOps.append('/pdfXplodeOverlay Do')
+
+    for pageIndex, inPage in enumerate(inPages):
+        cullable = None
+        if cull and isinstance(inPage, InputPDFPage):
+            inReaderPage = inPage.getPyPDF2PageObject()
+            inReader = inPage.pdfFile.getPyPDF2Reader()
+            try:
+                with tracing.span('pdf.analyzeContents', page=inPage.pageNumber):
+                    srcOps = parseContents(inReader, inReaderPage)
+                    if srcOps is not None:
+                        cullable = CullableContents(
+                            inReader, srcOps, inReaderPage.get('/Resources'))
+            except Exception:
+                # PyPDF2 can fall over on all sorts of content streams.
+                # Culling is only an optimization so just skip it.
+                cullable = None
+
+        if cullable is None:
+            xobjects['/pdfXplodeSrc'] = _makeSourceXObject(writer, inPage)
+
+        # The crop rect is top-down like everything else in Qt but the
+        # source page is in PDF coordinates.  The crop rect also becomes the
+        # clip rect so neighbouring content doesn't leak onto the edge tiles.
+        cropY = inPage.getSizeF().height() - cropRect.y() - cropRect.height()
+        cropClip = QRectF(cropRect.x(), cropY,
+                          cropRect.width(), cropRect.height())
+
+        for tileIndex, tileXform in enumerate(tileXforms):
+            percentComplete = \
+                ((pageIndex * numTiles + tileIndex) * 100) // numPages
+            if progress and not progress(percentComplete,
+                                         writer.bytesWritten()):
+                # Don't leave half a PDF lying around
+                writer.abort()
+                return
+
+            xform = QTransform(tileXform)
+            xform.translate(-cropRect.x(), -cropY)
             assert xform.isAffine()
             ctm = (
                 xform.m11(),
@@ -266,20 +539,35 @@ def generatePDFFromPDF(fileName, inPage, cropRect, outSize,
                 xform.m31(),
                 xform.m32()
             )
-            page = outPDF.addBlankPage(fullRect.width(), fullRect.height())
-            page.mergeTransformedPage(inReaderPage, ctm)
 
-            if overlayPage:
-                page.mergePage(overlayPage)
+            clipRect = cropClip
+            if cullable is not None:
+                # Only what this page shows of the source, in its coordinates
+                clipRect = xform.inverted()[0].mapRect(visibleRect)
+                clipRect = clipRect.intersected(cropClip)
+                with tracing.span('pdf.cull'):
+                    data = cullable.cull((clipRect.left(), clipRect.top(),
+                                          clipRect.right(), clipRect.bottom()))
+                xobjects['/pdfXplodeSrc'] = \
+                    _makeSourceXObject(writer, inPage, data)
+
+            clip = (clipRect.x(), clipRect.y(),
+                    clipRect.width(), clipRect.height())
+            content = '\n'.join([
+                'q',
+                ' '.join(_pdfNumber(v) for v in ctm) + ' cm',
+                ' '.join(_pdfNumber(v) for v in clip) + ' re W n',
+            ] + tileOps).encode('ascii')
+
+            with tracing.span('pdf.writePage'):
+                writer.addPage(fullRect.width(), fullRect.height(), content,
+                               xobjects)
+
+    with tracing.span('pdf.close'):
+        writer.close()
 
     if progress:
-        progress((numPages * 100) // (numPages + 1))
-
-    with open(fileName, 'wb') as f:
-        outPDF.write(f)
-
-    if progress:
-        progress(100)
+        progress(100, writer.bytesWritten())
 
 
 class ThreadedOperationRunnable(QRunnable):
@@ -297,6 +585,8 @@ class ThreadedOperationRunnable(QRunnable):
 
 class ThreadedOperation(QObject):
     progress = pyqtSignal(int)
+    bytesWritten = pyqtSignal('qint64')
+    finished = pyqtSignal(object)
 
     def __init__(self, func, *args, **kwargs):
         super(ThreadedOperation, self).__init__()
@@ -306,21 +596,53 @@ class ThreadedOperation(QObject):
         assert 'progress' not in kwargs
         kwargs['progress'] = self._reportProgress
 
-        self._runnable = ThreadedOperationRunnable(func, *args, **kwargs)
+        self._runnable = ThreadedOperationRunnable(self._runAndReport,
+                                                   func, *args, **kwargs)
+        # We hang on to the runnable so we can take it back off the queue
+        # in cancel().  Don't let the thread pool delete it out from under
+        # us.
+        self._runnable.setAutoDelete(False)
         self._canceled = False
+        self._threadPool = QThreadPool.globalInstance()
+
+    def _runAndReport(self, func, *args, **kwargs):
+        # An exception escaping QRunnable.run() takes down the whole
+        # process so report it and finish with None instead.  Everyone
+        # waiting on us still gets to clear out their pending state.
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        QMetaObject.invokeMethod(self, "finished",
+                                 Qt.QueuedConnection,
+                                 Q_ARG(object, result))
 
-    def _reportProgress(self, p):
+    def _reportProgress(self, p, bytesWritten=None):
         QMetaObject.invokeMethod(self, "progress",
                                  Qt.QueuedConnection,
                                  Q_ARG(int, p))
+        if bytesWritten is not None:
+            QMetaObject.invokeMethod(self, "bytesWritten",
+                                     Qt.QueuedConnection,
+                                     Q_ARG('qint64', bytesWritten))
         return not self._canceled;
 
     def cancel(self):
+        """Asks the operation to stop
+
+        Returns True if it hadn't started yet, in which case it never will
+        and finished is never emitted.
+        """
         self._canceled = True
+        # If it hasn't started yet, don't bother running it at all
+        return self._threadPool.tryTake(self._runnable)
 
     def run(self):
         print("Running...")
         self._runnable.run()
 
-    def runInThread(self):
-        QThreadPool.globalInstance().start(self._runnable)
+    def runInThread(self, threadPool=None):
+        if threadPool is not None:
+            self._threadPool = threadPool
+        self._threadPool.start(self._runnable)
@@ -0,0 +1,175 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from lazyPixmaps import LazyPixmaps
+from PyQt5.QtCore import pyqtSignal, QPoint, QSize, Qt, QThreadPool, QTimer
+from PyQt5.QtGui import QIcon, QPixmap
+from PyQt5.QtWidgets import (
+    QAbstractItemView,
+    QListView,
+    QListWidget,
+    QListWidgetItem,
+)
+
+# Size of the square each thumbnail is fit into, in pixels
+THUMBNAIL_SIZE = 96
+
+# Number of rendered thumbnails to keep around regardless of how few are
+# visible
+MIN_CACHED_THUMBNAILS = 128
+
+# Thumbnails get their own threads so a screenful of them doesn't queue up
+# in front of the preview's tiles
+THUMBNAIL_THREADS = 2
+
+def _renderThumbnail(inputPage, size, progress=None):
+    # The thumbnail may have scrolled out of view while it was queued
+    if progress and not progress(0):
+        return None
+
+    pageSize = inputPage.getSizeF()
+    scale = size / max(pageSize.width(), pageSize.height())
+    return inputPage.getQImage(QSize(max(2, round(pageSize.width() * scale)),
+                                     max(2, round(pageSize.height() * scale))))
+
+
+class PageThumbnailList(QListWidget):
+    """A strip of page thumbnails for navigating a PDF
+
+    Thumbnails are rendered at low resolution on a thread pool, and only
+    for the pages that are visible.  Renders for pages which scroll out of
+    view before they're done are canceled and the least recently shown
+    thumbnails are dropped once there are too many.
+    """
+    pageSelected = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super(PageThumbnailList, self).__init__(parent)
+
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.TopToBottom)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        labelHeight = self.fontMetrics().height()
+        self.setGridSize(QSize(THUMBNAIL_SIZE + 16,
+                               THUMBNAIL_SIZE + labelHeight + 16))
+        self.setFixedWidth(THUMBNAIL_SIZE + 24 +
+                           self.verticalScrollBar().sizeHint().width())
+
+        placeholder = QPixmap(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        placeholder.fill(Qt.lightGray)
+        self._placeholder = QIcon(placeholder)
+
+        self._pdfFile = None
+        self._updatePending = False
+        self._settingPage = False
+
+        self._threadPool = QThreadPool(self)
+        self._threadPool.setMaxThreadCount(THUMBNAIL_THREADS)
+        self._thumbnails = LazyPixmaps(MIN_CACHED_THUMBNAILS,
+                                       self._thumbnailRendered,
+                                       self._thumbnailDropped,
+                                       self._threadPool)
+
+        self.currentRowChanged.connect(self._currentRowChanged)
+        self.verticalScrollBar().valueChanged.connect(self._scheduleUpdate)
+
+    def cancelAll(self):
+        self._thumbnails.cancelAll()
+
+    def setPDFFile(self, pdfFile):
+        self.cancelAll()
+        self._settingPage = True
+        self.clear()
+        self._pdfFile = pdfFile
+        if pdfFile is not None:
+            for pageNumber in range(1, pdfFile.getNumPages() + 1):
+                self.addItem(QListWidgetItem(self._placeholder,
+                                             str(pageNumber)))
+        self._settingPage = False
+        self._scheduleUpdate()
+
+    def setCurrentPage(self, pageNumber):
+        self._settingPage = True
+        self.setCurrentRow(pageNumber - 1)
+        self._settingPage = False
+        item = self.currentItem()
+        if item is not None:
+            self.scrollToItem(item)
+
+    def _currentRowChanged(self, row):
+        if not self._settingPage and row >= 0:
+            self.pageSelected.emit(row + 1)
+
+    def _scheduleUpdate(self):
+        # Scrolling generates lots of events so only look once per event
+        # loop pass
+        if not self._updatePending:
+            self._updatePending = True
+            QTimer.singleShot(0, self._updateThumbnails)
+
+    def resizeEvent(self, event):
+        super(PageThumbnailList, self).resizeEvent(event)
+        self._scheduleUpdate()
+
+    def showEvent(self, event):
+        super(PageThumbnailList, self).showEvent(event)
+        self._scheduleUpdate()
+
+    def _rowAt(self, y, direction):
+        # Icons are centred in their grid cells so y may land between two
+        # of them.  Walk towards the next one, at most a cell away.
+        x = self.viewport().width() // 2
+        for offset in range(0, self.gridSize().height(), 4):
+            index = self.indexAt(QPoint(x, y + direction * offset))
+            if index.isValid():
+                return index.row()
+        return None
+
+    def _visibleRows(self):
+        # There's one column of thumbnails so everything between the rows
+        # at the top and bottom of the viewport is visible
+        viewRect = self.viewport().rect()
+        first = self._rowAt(viewRect.top(), 1)
+        if first is None:
+            return []
+        last = self._rowAt(viewRect.bottom(), -1)
+        if last is None:
+            last = self.count() - 1
+        return list(range(first, last + 1))
+
+    def _updateThumbnails(self):
+        self._updatePending = False
+        if self._pdfFile is None or not self.isVisible():
+            return
+
+        visibleRows = self._visibleRows()
+        self._thumbnails.setVisible(visibleRows)
+        for row in visibleRows:
+            if self._thumbnails.get(row) is None and \
+               not self._thumbnails.isPending(row):
+                self._thumbnails.request(row, _renderThumbnail,
+                                         self._pdfFile.getPage(row + 1),
+                                         THUMBNAIL_SIZE)
+
+    def _thumbnailRendered(self, row):
+        self.item(row).setIcon(QIcon(self._thumbnails.get(row)))
+
+    def _thumbnailDropped(self, row):
+        self.item(row).setIcon(self._placeholder)
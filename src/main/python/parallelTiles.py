@@ -0,0 +1,125 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+from inputPDF import InputPDFFile, InputPDFPage
+from inputImage import InputImage
+import multiprocessing
+import os
+from PyQt5.QtCore import QRectF, QSize
+from PyQt5.QtGui import QImage
+import tracing
+
+# Number of tiles to keep in flight per worker process.  More than one
+# keeps the workers busy while the caller paints; much more than that just
+# piles finished tiles up in memory.
+TILES_IN_FLIGHT_PER_PROCESS = 2
+
+# Files and pages opened by this worker process, keyed by file name and by
+# _renderSource() respectively
+_workerFiles = {}
+_workerInputs = {}
+
+def _renderSource(inPage):
+    # Something picklable which lets a worker process open its own copy of
+    # the input.  Poppler documents can't be shared between processes.
+    if isinstance(inPage, InputPDFPage):
+        return ('pdf', inPage.pdfFile.fileName, inPage.pageNumber)
+    elif isinstance(inPage, InputImage):
+        return ('image', inPage.fileName)
+    else:
+        raise TypeError("Unsupported input type")
+
+
+def _renderTileInWorker(source, region, size):
+    inPage = _workerInputs.get(source)
+    if inPage is None:
+        if source[0] == 'pdf':
+            pdfFile = _workerFiles.get(source[1])
+            if pdfFile is None:
+                # Every tile is a different region so caching renders here,
+                # in memory or on disk, is just wasted effort.
+                pdfFile = InputPDFFile(source[1], renderCacheBudget=0)
+                _workerFiles[source[1]] = pdfFile
+            inPage = pdfFile.getPage(source[2])
+        else:
+            inPage = InputImage(source[1])
+        _workerInputs[source] = inPage
+
+    image = inPage.getQImage(QSize(*size), QRectF(*region), cache=False)
+    data = image.constBits().asstring(image.sizeInBytes())
+    return (image.width(), image.height(), image.bytesPerLine(),
+            int(image.format()), data)
+
+
+def _qImageFromWorker(result):
+    width, height, bytesPerLine, imageFormat, data = result
+    return QImage(data, width, height, bytesPerLine, QImage.Format(imageFormat))
+
+
+def iterTileImages(tiles, processes=None):
+    """Renders tiles of input pages in a pool of worker processes
+
+    tiles is a list of (inPage, region, sizeHint) tuples, where region and
+    sizeHint are as passed to getQImage(), or None for tiles with nothing
+    to render.  The rendered QImages, or None, are yielded in the same
+    order as tiles.  Closing the generator
+    cancels any tiles which haven't been rendered yet.
+    """
+    if not processes:
+        processes = os.cpu_count() or 1
+
+    # Forking a process with Qt's threads running is asking for trouble
+    context = multiprocessing.get_context('spawn')
+    executor = concurrent.futures.ProcessPoolExecutor(processes,
+                                                      mp_context=context)
+    pending = collections.deque()
+    tileIter = iter(tiles)
+
+    def submitNext():
+        try:
+            tile = next(tileIter)
+        except StopIteration:
+            return
+        if tile is None:
+            pending.append(None)
+        else:
+            inPage, region, size = tile
+            pending.append(executor.submit(
+                _renderTileInWorker, _renderSource(inPage),
+                (region.x(), region.y(), region.width(), region.height()),
+                (size.width(), size.height())))
+
+    try:
+        for i in range(processes * TILES_IN_FLIGHT_PER_PROCESS):
+            submitNext()
+
+        while pending:
+            future = pending.popleft()
+            submitNext()
+            if future is None:
+                yield None
+            else:
+                with tracing.span('render.tileWait'):
+                    result = future.result()
+                with tracing.span('qimage.construct'):
+                    image = _qImageFromWorker(result)
+                yield image
+    finally:
+        for future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,423 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The PDF libraries used to copy pages across without rasterizing them
+
+A backend reads pages out of input PDFs and writes the exploded PDF out of
+Form XObjects: one per source page or JPEG, plus the overlay, which each
+output page draws with its own content stream.  The content streams
+themselves are built by outputPDF so every backend produces the same
+pages.
+
+PyPDF2 is the default.  pikepdf, which wraps the qpdf C++ library, is much
+faster on big documents and is used when it is asked for by name, by
+setting PDFXPLODE_PDF_BACKEND or by asking for "auto".  The catch is that
+qpdf builds the whole output in memory and only writes it when it's
+closed, so unlike PyPDF2's streaming writer, memory use grows with the
+output and there's no count of bytes written until the very end.
+"""
+
+import collections
+import os
+from pdfWriter import StreamingPDFWriter
+import PyPDF2
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    NameObject,
+    NumberObject,
+)
+from PyPDF2.pdf import PageObject
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+BACKEND_ENV = 'PDFXPLODE_PDF_BACKEND'
+
+DEFAULT_BACKEND = 'pypdf2'
+
+JPEG_COLOR_SPACES = {
+    1: '/DeviceGray',
+    3: '/DeviceRGB',
+    4: '/DeviceCMYK',
+}
+
+def _jpegFormContent(info):
+    # Maps the image onto its pixel grid so it can be placed exactly like a
+    # PDF page with the crop in pixels
+    return 'q {} 0 0 {} 0 0 cm /pdfXplodeImage Do Q'.format(
+           info.width, info.height).encode('ascii')
+
+
+class PDFBackend(object):
+    """A PDF library that can copy pages into a new PDF"""
+    name = None
+
+    @classmethod
+    def isAvailable(cls):
+        return True
+
+    def openDocument(self, stream):
+        """Opens the PDF in the file object stream for reading pages
+
+        This is called once per InputPDFFile and the result is cached by
+        InputPDFFile.getBackendDocument().
+        """
+        raise NotImplementedError()
+
+    def openWriter(self, fileName):
+        """Returns a PDFBackendWriter which writes to fileName"""
+        raise NotImplementedError()
+
+
+class PDFBackendWriter(object):
+    """A PDF being written by a PDFBackend
+
+    The add*XObject() methods return a handle which can be passed to
+    addPage() as many times as needed.
+    """
+    def addPageXObject(self, inPage, data=None):
+        """Adds the InputPDFPage inPage as a Form XObject
+
+        If data is given, it replaces the page's content stream.
+        """
+        raise NotImplementedError()
+
+    def addJPEGXObject(self, inImage):
+        """Adds the JPEG InputImage inImage as a Form XObject, without
+        re-encoding it, which draws it with one unit per pixel
+        """
+        raise NotImplementedError()
+
+    def addFormXObject(self, data, width, height):
+        """Adds a Form XObject with the content stream data and no
+        resources covering (0, 0, width, height)
+        """
+        raise NotImplementedError()
+
+    def addPage(self, width, height, data, xobjects):
+        """Adds a page with the content stream data
+
+        xobjects maps the names used by data to XObject handles.
+        """
+        raise NotImplementedError()
+
+    def bytesWritten(self):
+        return 0
+
+    def close(self):
+        raise NotImplementedError()
+
+    def abort(self):
+        """Stops writing and deletes whatever has been written so far"""
+        raise NotImplementedError()
+
+
+class _PyPDF2Writer(PDFBackendWriter):
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._file = open(fileName, 'wb')
+        # Pages are written out as soon as they're done rather than piling
+        # up in a PdfFileWriter until the very end.
+        self._writer = StreamingPDFWriter(self._file)
+
+    def addPageXObject(self, inPage, data=None):
+        inReaderPage = inPage.getPyPDF2PageObject()
+        if data is None:
+            contents = inReaderPage.getContents()
+            if contents is None:
+                data = b''
+            elif isinstance(contents, ArrayObject):
+                data = b'\n'.join(c.getObject().getData() for c in contents)
+            else:
+                data = contents.getData()
+
+        stream = DecodedStreamObject()
+        stream.setData(data)
+        xobj = stream.flateEncode()
+        xobj.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): inReaderPage.mediaBox,
+            NameObject('/Resources'):
+                inReaderPage.get('/Resources', DictionaryObject()),
+        })
+        return self._writer.addObject(xobj)
+
+    def addJPEGXObject(self, inImage):
+        info = inImage.getJPEGInfo()
+        with open(inImage.fileName, 'rb') as f:
+            data = f.read()
+
+        image = EncodedStreamObject()
+        image._data = data
+        image.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Image'),
+            NameObject('/Width'): NumberObject(info.width),
+            NameObject('/Height'): NumberObject(info.height),
+            NameObject('/ColorSpace'):
+                NameObject(JPEG_COLOR_SPACES[info.components]),
+            NameObject('/BitsPerComponent'): NumberObject(8),
+            NameObject('/Filter'): NameObject('/DCTDecode'),
+        })
+        if info.components == 4 and info.adobe:
+            image[NameObject('/Decode')] = \
+                ArrayObject([NumberObject(v) for v in [1, 0] * 4])
+        imageRef = self._writer.addObject(image)
+
+        resources = DictionaryObject({
+            NameObject('/XObject'): DictionaryObject({
+                NameObject('/pdfXplodeImage'): imageRef,
+            }),
+        })
+        return self._addForm(_jpegFormContent(info), info.width, info.height,
+                             resources)
+
+    def _addForm(self, data, width, height, resources):
+        form = DecodedStreamObject()
+        form.setData(data)
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/BBox'): ArrayObject([
+                NumberObject(0), NumberObject(0),
+                NumberObject(width), NumberObject(height),
+            ]),
+            NameObject('/Resources'): resources,
+        })
+        return self._writer.addObject(form)
+
+    def addFormXObject(self, data, width, height):
+        return self._addForm(data, width, height, DictionaryObject())
+
+    def addPage(self, width, height, data, xobjects):
+        content = DecodedStreamObject()
+        content.setData(data)
+
+        page = PageObject.createBlankPage(None, width, height)
+        page[NameObject('/Contents')] = content
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/XObject'): DictionaryObject(
+                (NameObject(name), ref) for name, ref in xobjects.items()),
+        })
+        self._writer.addPage(page)
+
+    def bytesWritten(self):
+        return self._writer.bytesWritten()
+
+    def close(self):
+        self._writer.close()
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._fileName)
+
+
+class PyPDF2Backend(PDFBackend):
+    name = 'pypdf2'
+
+    def openDocument(self, stream):
+        return PyPDF2.PdfFileReader(stream)
+
+    def openWriter(self, fileName):
+        return _PyPDF2Writer(fileName)
+
+
+def _pikeInherited(page, key):
+    # Resources and the media box may be on any of the page's ancestors
+    node = page
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get('/Parent')
+    return None
+
+
+def _pikeCopy(pdf, obj):
+    # qpdf only copies indirect objects from another document so direct
+    # dictionaries and arrays, like most pages' /Resources, are rebuilt
+    # around copies of whatever they hold
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        return pdf.copy_foreign(obj)
+    elif isinstance(obj, pikepdf.Dictionary):
+        return pikepdf.Dictionary({key: _pikeCopy(pdf, value)
+                                   for key, value in obj.items()})
+    elif isinstance(obj, pikepdf.Array):
+        return pikepdf.Array([_pikeCopy(pdf, value) for value in obj])
+    else:
+        return obj
+
+
+class _PikePDFWriter(PDFBackendWriter):
+    def __init__(self, backend, fileName):
+        self._backend = backend
+        self._fileName = fileName
+        self._pdf = pikepdf.Pdf.new()
+        self._bytesWritten = 0
+
+        # Copied resources of each source page, so the per-page content
+        # used for culling doesn't copy them every time
+        self._resources = {}
+
+    def _pageResources(self, inPage, page):
+        key = (id(inPage.pdfFile), inPage.pageNumber)
+        resources = self._resources.get(key)
+        if resources is None:
+            resources = _pikeInherited(page, '/Resources')
+            if resources is None:
+                resources = pikepdf.Dictionary()
+            else:
+                resources = _pikeCopy(self._pdf, resources)
+            self._resources[key] = resources
+        return resources
+
+    def addPageXObject(self, inPage, data=None):
+        doc = inPage.pdfFile.getBackendDocument(self._backend)
+        page = doc.pages[inPage.pageNumber - 1].obj
+
+        filters = {}
+        if data is None:
+            contents = page.get('/Contents')
+            if contents is None:
+                data = b''
+            elif isinstance(contents, pikepdf.Array):
+                data = b'\n'.join(c.read_bytes() for c in contents)
+            else:
+                # A single stream can be copied across still compressed
+                data = contents.read_raw_bytes()
+                for key in ('/Filter', '/DecodeParms'):
+                    if key in contents:
+                        filters[key[1:]] = _pikeCopy(self._pdf,
+                                                     contents[key])
+
+        mediaBox = _pikeInherited(page, '/MediaBox')
+        return pikepdf.Stream(self._pdf, data,
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Form,
+            BBox=pikepdf.Array([float(v) for v in mediaBox]),
+            Resources=self._pageResources(inPage, page),
+            **filters)
+
+    def addJPEGXObject(self, inImage):
+        info = inImage.getJPEGInfo()
+        with open(inImage.fileName, 'rb') as f:
+            data = f.read()
+
+        image = pikepdf.Stream(self._pdf, data,
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Image,
+            Width=info.width,
+            Height=info.height,
+            ColorSpace=pikepdf.Name(JPEG_COLOR_SPACES[info.components]),
+            BitsPerComponent=8,
+            Filter=pikepdf.Name.DCTDecode)
+        if info.components == 4 and info.adobe:
+            image.Decode = pikepdf.Array([1, 0] * 4)
+
+        return pikepdf.Stream(self._pdf, _jpegFormContent(info),
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Form,
+            BBox=pikepdf.Array([0, 0, info.width, info.height]),
+            Resources=pikepdf.Dictionary(
+                XObject=pikepdf.Dictionary(pdfXplodeImage=image)))
+
+    def addFormXObject(self, data, width, height):
+        return pikepdf.Stream(self._pdf, data,
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Form,
+            BBox=pikepdf.Array([0, 0, width, height]),
+            Resources=pikepdf.Dictionary())
+
+    def addPage(self, width, height, data, xobjects):
+        page = pikepdf.Dictionary(
+            Type=pikepdf.Name.Page,
+            MediaBox=pikepdf.Array([0, 0, width, height]),
+            Contents=pikepdf.Stream(self._pdf, data),
+            Resources=pikepdf.Dictionary(
+                XObject=pikepdf.Dictionary(xobjects)))
+        self._pdf.pages.append(pikepdf.Page(self._pdf.make_indirect(page)))
+
+    def bytesWritten(self):
+        # Zero until close() as nothing is written before then
+        return self._bytesWritten
+
+    def close(self):
+        # qpdf only writes the file at the very end
+        self._pdf.save(self._fileName, compress_streams=True)
+        self._pdf.close()
+        self._bytesWritten = os.path.getsize(self._fileName)
+
+    def abort(self):
+        self._pdf.close()
+
+
+class PikePDFBackend(PDFBackend):
+    name = 'pikepdf'
+
+    @classmethod
+    def isAvailable(cls):
+        return pikepdf is not None
+
+    def openDocument(self, stream):
+        return pikepdf.open(stream)
+
+    def openWriter(self, fileName):
+        return _PikePDFWriter(self, fileName)
+
+
+# In order of preference for "auto".  That's fastest first, even though
+# pikepdf holds the whole output in memory until it's closed.
+BACKENDS = collections.OrderedDict([
+    (PikePDFBackend.name, PikePDFBackend),
+    (PyPDF2Backend.name, PyPDF2Backend),
+])
+
+BACKEND_NAMES = ['auto'] + list(BACKENDS)
+
+_instances = {}
+
+def availableBackends():
+    return [name for name, cls in BACKENDS.items() if cls.isAvailable()]
+
+
+def getBackend(name=None):
+    """Returns the PDFBackend called name
+
+    If name is None, it comes from the PDFXPLODE_PDF_BACKEND environment
+    variable or defaults to PyPDF2.  "auto" picks the fastest one that is
+    installed.  Raises ValueError for unknown or missing backends.
+    """
+    if name is None:
+        name = os.environ.get(BACKEND_ENV) or DEFAULT_BACKEND
+    if name == 'auto':
+        name = availableBackends()[0]
+
+    cls = BACKENDS.get(name)
+    if cls is None:
+        raise ValueError("Unknown PDF backend: " + name)
+    if not cls.isAvailable():
+        raise ValueError("PDF backend {} is not installed".format(name))
+
+    backend = _instances.get(name)
+    if backend is None:
+        backend = cls()
+        _instances[name] = backend
+    return backend
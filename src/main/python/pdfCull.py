@@ -0,0 +1,438 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import math
+from PyPDF2.generic import FloatObject, NameObject, NumberObject
+from PyPDF2.pdf import ContentStream
+
+# We don't look at font metrics so a glyph is assumed to be no more than
+# this many ems wide per byte of string and this tall above and below the
+# baseline.  Multi-byte encodings just make this more conservative.
+TEXT_ADVANCE_EMS = 1.5
+TEXT_EXTENT_EMS = 1.5
+
+# Stroked paths are grown by this many line widths to cover caps and
+# miter joins
+STROKE_SLACK_WIDTHS = 5
+
+# Everything is grown by this much, in points of the page's default user
+# space, so anti-aliasing right at the edge of a tile doesn't get lost
+CULL_SLACK = 1
+
+PATH_CONSTRUCTION_OPS = {b'm', b'l', b'c', b'v', b'y', b're', b'h'}
+PATH_PAINTING_OPS = {b'S', b's', b'f', b'F', b'f*', b'B', b'B*', b'b', b'b*',
+                     b'n'}
+STROKING_OPS = {b'S', b's', b'B', b'B*', b'b', b'b*'}
+CLIPPING_OPS = {b'W', b'W*'}
+TEXT_SHOWING_OPS = {b'Tj', b'TJ', b"'", b'"'}
+TEXT_POSITIONING_OPS = {b'Td', b'TD', b'Tm', b'T*', b"'", b'"', b'ET'}
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+def _multiply(m, n):
+    # The PDF convention: the result maps through m and then n
+    return (m[0] * n[0] + m[1] * n[2],
+            m[0] * n[1] + m[1] * n[3],
+            m[2] * n[0] + m[3] * n[2],
+            m[2] * n[1] + m[3] * n[3],
+            m[4] * n[0] + m[5] * n[2] + n[4],
+            m[4] * n[1] + m[5] * n[3] + n[5])
+
+
+def _transform(m, x, y):
+    return (m[0] * x + m[2] * y + m[4], m[1] * x + m[3] * y + m[5])
+
+
+def _scale(m):
+    # The most a length can be stretched by m
+    return max(math.hypot(m[0], m[1]), math.hypot(m[2], m[3]))
+
+
+def _boundsOf(points):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _transformedBounds(m, x0, y0, x1, y1):
+    return _boundsOf([_transform(m, x, y) for x, y in
+                      ((x0, y0), (x1, y0), (x0, y1), (x1, y1))])
+
+
+def _grow(bounds, amount):
+    return (bounds[0] - amount, bounds[1] - amount,
+            bounds[2] + amount, bounds[3] + amount)
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _numbers(operands):
+    return [float(v) for v in operands]
+
+
+class _GraphicsState(object):
+    def __init__(self):
+        self.ctm = IDENTITY
+        self.lineWidth = 1
+        self.fontName = None
+        self.fontSize = 0
+        self.charSpacing = 0
+        self.wordSpacing = 0
+        self.horizScale = 1
+        self.leading = 0
+        self.rise = 0
+        self.renderMode = 0
+
+    def copy(self):
+        state = _GraphicsState()
+        state.__dict__.update(self.__dict__)
+        return state
+
+
+class _Analyzer(object):
+    def __init__(self, reader, resources):
+        self.reader = reader
+        self.resources = resources
+        self.state = _GraphicsState()
+        self.stack = []
+
+        # Text object state
+        self.lineMatrix = IDENTITY
+        self.lineLo = 0
+        self.lineHi = 0
+
+        # Path under construction
+        self.pathOps = []
+        self.pathPoints = []
+        self.pathClips = False
+
+    def _resource(self, category, name):
+        if self.resources is None:
+            return None
+        category = self.resources.get(category)
+        if category is None:
+            return None
+        obj = category.getObject().get(name)
+        return obj.getObject() if obj is not None else None
+
+    def _unitSquareBounds(self):
+        return _transformedBounds(self.state.ctm, 0, 0, 1, 1)
+
+    def _xObjectBounds(self, name):
+        # Returns None if we don't know where it draws
+        xobj = self._resource('/XObject', name)
+        if xobj is None:
+            return None
+
+        subtype = xobj.get('/Subtype')
+        if subtype == '/Image':
+            return self._unitSquareBounds()
+        elif subtype == '/Form' and '/BBox' in xobj:
+            matrix = IDENTITY
+            if '/Matrix' in xobj:
+                matrix = tuple(_numbers(xobj['/Matrix']))
+            bbox = _numbers(xobj['/BBox'])
+            return _transformedBounds(
+                       _multiply(matrix, self.state.ctm),
+                       min(bbox[0], bbox[2]), min(bbox[1], bbox[3]),
+                       max(bbox[0], bbox[2]), max(bbox[1], bbox[3]))
+        else:
+            return None
+
+    def _canCullFont(self):
+        # Vertical writing and Type 3 glyphs can go anywhere
+        font = self._resource('/Font', self.state.fontName)
+        if font is None:
+            return False
+        if font.get('/Subtype') == '/Type3':
+            return False
+        encoding = font.get('/Encoding')
+        return not (isinstance(encoding, NameObject) and
+                    encoding.endswith('-V'))
+
+    def _showAdvance(self, operands, operator):
+        # Returns the (least, most) the text position can move, in
+        # unscaled text space
+        state = self.state
+        em = abs(state.fontSize) * TEXT_ADVANCE_EMS
+        perByteLo = min(0, state.charSpacing)
+        perByteHi = em + abs(state.charSpacing) + abs(state.wordSpacing)
+
+        if operator == b'TJ':
+            items = operands[0]
+        else:
+            items = operands[-1:]
+
+        lo = hi = 0
+        for item in items:
+            if isinstance(item, (NumberObject, FloatObject)):
+                shift = -float(item) / 1000 * state.fontSize
+                lo += shift
+                hi += shift
+            else:
+                # Text strings were decoded from the bytes in the stream
+                numBytes = len(getattr(item, 'original_bytes', item))
+                lo += numBytes * perByteLo
+                hi += numBytes * perByteHi
+        return lo * state.horizScale, hi * state.horizScale
+
+    def _nextLine(self, tx, ty):
+        self.lineMatrix = _multiply((1, 0, 0, 1, tx, ty), self.lineMatrix)
+        self.lineLo = self.lineHi = 0
+
+    def _textBounds(self, lo, hi):
+        state = self.state
+        extent = abs(state.fontSize) * TEXT_EXTENT_EMS + abs(state.rise)
+        textToDevice = _multiply(self.lineMatrix, state.ctm)
+        return _transformedBounds(textToDevice, lo, -extent, hi, extent)
+
+    def _safeToDropShows(self, ops):
+        # Showing text moves the text position so we can only drop it if
+        # whatever comes next doesn't depend on where it left off.  Returns
+        # whether that holds after each op, worked out back to front so
+        # it's one pass over the page.
+        safe = [True] * len(ops)
+        nextSafe = True
+        for index in range(len(ops) - 1, -1, -1):
+            safe[index] = nextSafe
+            operator = ops[index][1]
+            if operator in TEXT_POSITIONING_OPS:
+                nextSafe = True
+            elif operator in TEXT_SHOWING_OPS:
+                nextSafe = False
+        return safe
+
+    def _emit(self, ops, bounds=None, dropOps=[]):
+        # Appends a chunk of content which is only needed if bounds is
+        # visible.  Runs of chunks which are always needed are merged.
+        if bounds is None and self.chunks and self.chunks[-1][1] is None:
+            self.chunks[-1][0].extend(ops)
+        elif bounds is None:
+            self.chunks.append((list(ops), None, []))
+        else:
+            self.chunks.append((ops, _grow(bounds, CULL_SLACK), dropOps))
+
+    def _flushPath(self):
+        self._emit(self.pathOps)
+        self._resetPath()
+
+    def _resetPath(self):
+        self.pathOps = []
+        self.pathPoints = []
+        self.pathClips = False
+
+    def analyze(self, ops):
+        """Splits ops up into chunks of (data, bounds, data if not visible)
+
+        bounds is None for anything which always has to be kept.
+        """
+        self.chunks = []
+        safeToDropShow = self._safeToDropShows(ops)
+        for index, (operands, operator) in enumerate(ops):
+            state = self.state
+
+            if operator in PATH_CONSTRUCTION_OPS:
+                self.pathOps.append((operands, operator))
+                nums = _numbers(operands)
+                if operator == b're':
+                    x, y, w, h = nums
+                    corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
+                else:
+                    corners = zip(nums[0::2], nums[1::2])
+                self.pathPoints.extend(_transform(state.ctm, x, y)
+                                       for x, y in corners)
+                continue
+            elif operator in CLIPPING_OPS:
+                self.pathOps.append((operands, operator))
+                self.pathClips = True
+                continue
+            elif operator in PATH_PAINTING_OPS:
+                self.pathOps.append((operands, operator))
+                if self.pathClips:
+                    self._flushPath()
+                elif operator == b'n' or not self.pathPoints:
+                    # Paints nothing
+                    self._resetPath()
+                else:
+                    bounds = _boundsOf(self.pathPoints)
+                    if operator in STROKING_OPS:
+                        bounds = _grow(bounds, state.lineWidth *
+                                       STROKE_SLACK_WIDTHS *
+                                       _scale(state.ctm))
+                    self._emit(self.pathOps, bounds)
+                    self._resetPath()
+                continue
+            elif self.pathOps:
+                # Something other than a path operator in the middle of a
+                # path isn't allowed but don't make it any worse.
+                self._flushPath()
+
+            if operator == b'q':
+                self.stack.append(state.copy())
+            elif operator == b'Q':
+                if self.stack:
+                    self.state = self.stack.pop()
+            elif operator == b'cm':
+                state.ctm = _multiply(tuple(_numbers(operands)), state.ctm)
+            elif operator == b'w':
+                state.lineWidth = float(operands[0])
+            elif operator == b'gs':
+                extGState = self._resource('/ExtGState', operands[0])
+                if extGState is not None and '/LW' in extGState:
+                    state.lineWidth = max(state.lineWidth,
+                                          float(extGState['/LW']))
+            elif operator == b'BT':
+                self.lineMatrix = IDENTITY
+                self.lineLo = self.lineHi = 0
+            elif operator == b'Tf':
+                state.fontName = operands[0]
+                state.fontSize = float(operands[1])
+            elif operator == b'Tc':
+                state.charSpacing = float(operands[0])
+            elif operator == b'Tw':
+                state.wordSpacing = float(operands[0])
+            elif operator == b'Tz':
+                state.horizScale = float(operands[0]) / 100
+            elif operator == b'TL':
+                state.leading = float(operands[0])
+            elif operator == b'Ts':
+                state.rise = float(operands[0])
+            elif operator == b'Tr':
+                state.renderMode = int(operands[0])
+            elif operator == b'Td':
+                self._nextLine(*_numbers(operands))
+            elif operator == b'TD':
+                tx, ty = _numbers(operands)
+                state.leading = -ty
+                self._nextLine(tx, ty)
+            elif operator == b'Tm':
+                self.lineMatrix = tuple(_numbers(operands))
+                self.lineLo = self.lineHi = 0
+            elif operator == b'T*':
+                self._nextLine(0, -state.leading)
+            elif operator in TEXT_SHOWING_OPS:
+                if operator == b'"':
+                    state.wordSpacing = float(operands[0])
+                    state.charSpacing = float(operands[1])
+                if operator in (b"'", b'"'):
+                    self._nextLine(0, -state.leading)
+
+                lo, hi = self._showAdvance(operands, operator)
+                startLo, startHi = self.lineLo, self.lineHi
+                self.lineLo += lo
+                self.lineHi += hi
+
+                # Text render modes 4-7 add to the clip
+                if state.renderMode < 4 and self._canCullFont() and \
+                   safeToDropShow[index]:
+                    # Keep the side effects on the text state if it's
+                    # dropped
+                    dropOps = []
+                    if operator == b'"':
+                        dropOps.append((operands[:1], b'Tw'))
+                        dropOps.append((operands[1:2], b'Tc'))
+                    if operator in (b"'", b'"'):
+                        dropOps.append(([], b'T*'))
+                    self._emit([(operands, operator)],
+                               self._textBounds(min(startLo, self.lineLo),
+                                                max(startHi, self.lineHi)),
+                               dropOps)
+                    continue
+            elif operator == b'Do':
+                bounds = self._xObjectBounds(operands[0])
+                if bounds is not None:
+                    self._emit([(operands, operator)], bounds)
+                    continue
+            elif operator == b'INLINE IMAGE':
+                self._emit([(operands, operator)], self._unitSquareBounds())
+                continue
+
+            self._emit([(operands, operator)])
+
+        if self.pathOps:
+            self._flushPath()
+
+        # Serialize the whole page in one go and slice the chunks out of it
+        out = io.BytesIO()
+        offsets = []
+        for chunkOps, bounds, dropOps in self.chunks:
+            start = out.tell()
+            _writeOps(out, chunkOps)
+            middle = out.tell()
+            _writeOps(out, dropOps)
+            offsets.append((start, middle, out.tell()))
+        data = out.getvalue()
+
+        return [(data[start:middle], bounds, data[middle:end])
+                for (start, middle, end), (chunkOps, bounds, dropOps)
+                in zip(offsets, self.chunks)]
+
+
+def _writeOps(out, ops):
+    # The same as ContentStream._getData() but into a stream of our own
+    for operands, operator in ops:
+        if operator == b'INLINE IMAGE':
+            out.write(b'BI')
+            settings = io.BytesIO()
+            operands['settings'].writeToStream(settings, None)
+            out.write(settings.getvalue()[2:-2])
+            out.write(b'ID ')
+            out.write(operands['data'])
+            out.write(b'EI')
+        else:
+            for operand in operands:
+                operand.writeToStream(out, None)
+                out.write(b' ')
+            out.write(operator)
+        out.write(b'\n')
+
+
+def parseContents(reader, pyPDF2Page):
+    """Parses the page's content stream into a list of operations
+
+    Returns None if the page has no content.
+    """
+    contents = pyPDF2Page.getContents()
+    if contents is None:
+        return None
+    return ContentStream(contents, reader).operations
+
+
+class CullableContents(object):
+    """A page's content stream which can be cut down to a rect
+
+    The content is interpreted once up-front to work out where each path,
+    piece of text, image and so on is drawn.  After that, cull() is cheap
+    enough to do for every tile.  Only painting is ever removed and
+    anything we can't bound, like shadings or text we don't understand, is
+    kept.
+    """
+    def __init__(self, reader, operations, resources):
+        if resources is not None:
+            resources = resources.getObject()
+        self._chunks = _Analyzer(reader, resources).analyze(operations)
+
+    def cull(self, rect):
+        """Returns the content stream data with everything drawn entirely
+        outside of rect removed
+
+        rect is (x0, y0, x1, y1) in the default user space of the page.
+        """
+        return b''.join(data if bounds is None or _intersects(bounds, rect)
+                        else dropData
+                        for data, bounds, dropData in self._chunks)
@@ -0,0 +1,201 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+from pdfWriter import StreamingPDFWriter
+import PyPDF2
+import shutil
+from PyPDF2.generic import (
+    ArrayObject,
+    BooleanObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NullObject,
+    StreamObject,
+)
+import tracing
+
+# Streams shorter than this aren't worth the zlib header
+MIN_COMPRESS_BYTES = 64
+
+class _Resolver(object):
+    # Stands in for a PdfFileReader so the writer can pull the optimized
+    # objects through ordinary IndirectObjects
+    def __init__(self):
+        self.objects = {}
+
+    def getObject(self, ref):
+        return self.objects[ref.idnum]
+
+
+def _collectObjects(reader, pages):
+    # Returns {idnum: object} for everything the pages reference.  The page
+    # tree itself is rebuilt by the writer so we don't follow /Parent.
+    objects = {}
+    todo = []
+    for page in pages:
+        todo.extend(v for k, v in page.items() if k != '/Parent')
+
+    while todo:
+        obj = todo.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in objects:
+                continue
+            target = reader.getObject(obj)
+            objects[obj.idnum] = target
+            todo.append(target)
+        elif isinstance(obj, DictionaryObject):
+            todo.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            todo.extend(obj)
+    return objects
+
+
+class _Deduplicator(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.digests = {}
+        self.classes = {idnum: idnum for idnum in objects}
+
+    def _streamDigest(self, idnum, stream):
+        digest = self.digests.get(idnum)
+        if digest is None:
+            digest = hashlib.sha256(stream._data).digest()
+            self.digests[idnum] = digest
+        return digest
+
+    def _key(self, obj):
+        # A hashable stand-in for obj where references are replaced by the
+        # class of the object they point to
+        if isinstance(obj, IndirectObject):
+            return ('R', self.classes.get(obj.idnum, obj.idnum))
+        elif isinstance(obj, DictionaryObject):
+            return ('D', tuple(sorted((k, self._key(v))
+                                      for k, v in obj.items())))
+        elif isinstance(obj, ArrayObject):
+            return ('A', tuple(self._key(v) for v in obj))
+        elif isinstance(obj, BooleanObject):
+            return ('B', obj.value)
+        elif isinstance(obj, NullObject):
+            return ('N',)
+        else:
+            return (type(obj).__name__, obj)
+
+    def _objectKey(self, idnum, obj):
+        key = self._key(obj)
+        if isinstance(obj, StreamObject):
+            key = ('S', key, self._streamDigest(idnum, obj))
+        return key
+
+    def run(self):
+        """Returns {idnum: idnum of the identical object to use instead}
+
+        Objects are identical if they're the same apart from references to
+        objects which are themselves identical.  Every pass can only merge
+        more objects so we just repeat until nothing changes.
+        """
+        numClasses = len(self.classes)
+        while True:
+            groups = {}
+            classes = {}
+            for idnum in sorted(self.objects):
+                key = self._objectKey(idnum, self.objects[idnum])
+                classes[idnum] = groups.setdefault(key, idnum)
+            self.classes = classes
+
+            if len(groups) == numClasses:
+                return classes
+            numClasses = len(groups)
+
+
+def _compress(stream):
+    if '/Filter' in stream or len(stream._data) < MIN_COMPRESS_BYTES:
+        return stream
+    encoded = stream.flateEncode()
+    if len(encoded._data) >= len(stream._data):
+        return stream
+    # flateEncode() only sets /Filter
+    for key, value in stream.items():
+        if key not in encoded:
+            encoded[key] = value
+    return encoded
+
+
+def _remap(obj, classes, resolver):
+    if isinstance(obj, IndirectObject):
+        return IndirectObject(classes[obj.idnum], 0, resolver)
+    elif isinstance(obj, StreamObject):
+        copy = _compress(obj) if isinstance(obj, DecodedStreamObject) else obj
+        stream = copy.__class__()
+        stream._data = copy._data
+        for key, value in copy.items():
+            stream[key] = _remap(value, classes, resolver)
+        return stream
+    elif isinstance(obj, DictionaryObject):
+        return DictionaryObject((k, _remap(v, classes, resolver))
+                                for k, v in obj.items())
+    elif isinstance(obj, ArrayObject):
+        return ArrayObject(_remap(v, classes, resolver) for v in obj)
+    else:
+        return obj
+
+
+def optimizePDF(fileName, outFileName=None):
+    """Rewrites the PDF fileName with duplicate objects merged and any
+    uncompressed streams Flate-compressed
+
+    Only the pages and what they reference are kept, which is all there is
+    in the PDFs we write.  The result goes to outFileName or, if that's
+    None, replaces fileName.  The original is left alone if optimizing
+    doesn't make it any smaller.  Returns the number of bytes saved.
+    """
+    if outFileName is None:
+        outFileName = fileName
+    tmpFileName = outFileName + '.tmp'
+    inSize = os.path.getsize(fileName)
+
+    with open(fileName, 'rb') as inFile:
+        reader = PyPDF2.PdfFileReader(inFile, strict=False)
+        pages = [reader.getPage(i) for i in range(reader.getNumPages())]
+
+        with tracing.span('optimize.dedupe'):
+            objects = _collectObjects(reader, pages)
+            classes = _Deduplicator(objects).run()
+
+        with tracing.span('optimize.write'):
+            resolver = _Resolver()
+            for idnum, obj in objects.items():
+                if classes[idnum] == idnum:
+                    resolver.objects[idnum] = _remap(obj, classes, resolver)
+
+            with open(tmpFileName, 'wb') as outFile:
+                writer = StreamingPDFWriter(outFile)
+                for page in pages:
+                    page = DictionaryObject((k, v) for k, v in page.items()
+                                            if k != '/Parent')
+                    writer.addPage(_remap(page, classes, resolver))
+                writer.close()
+                outSize = writer.bytesWritten()
+
+    if outSize >= inSize:
+        os.remove(tmpFileName)
+        if outFileName != fileName:
+            shutil.copyfile(fileName, outFileName)
+        return 0
+
+    os.replace(tmpFileName, outFileName)
+    return inSize - outSize
@@ -0,0 +1,165 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import io
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+class StreamingPDFWriter(object):
+    """Writes a PDF out to a file as it is built
+
+    PyPDF2's PdfFileWriter keeps every object in memory until write() is
+    called at the very end.  This writes each object to the file as soon
+    as it's added and only keeps the offsets needed for the xref table.
+    Objects from other PDFs (a PdfFileReader, for instance) are copied in
+    the first time they're referenced and written once.
+
+    Once an object has been added, it's gone as far as the writer is
+    concerned so pages need to be complete before they're added.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._bytesWritten = 0
+        self._offsets = {}
+        self._nextId = 1
+        self._imported = {}
+        self._pending = collections.deque()
+        self._pageRefs = []
+
+        self._out(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        # Pages need to point at their parent before we've seen them all
+        self._pagesRef = self.reserveObject()
+
+    def _out(self, data):
+        self._stream.write(data)
+        self._bytesWritten += len(data)
+
+    def _outObject(self, obj):
+        buf = io.BytesIO()
+        obj.writeToStream(buf, None)
+        self._out(buf.getvalue())
+
+    def bytesWritten(self):
+        return self._bytesWritten
+
+    def getNumPages(self):
+        return len(self._pageRefs)
+
+    def reserveObject(self):
+        """Allocates an object number to be written later by writeObject()"""
+        ref = IndirectObject(self._nextId, 0, self)
+        self._nextId += 1
+        return ref
+
+    def _localize(self, obj, topLevel=False):
+        # Returns a copy of obj in which every reference points into this
+        # PDF, queueing up anything referenced that still needs writing.
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is self:
+                return obj
+
+            key = (obj.pdf, obj.idnum, obj.generation)
+            ref = self._imported.get(key)
+            if ref is None:
+                ref = self.reserveObject()
+                self._imported[key] = ref
+                self._pending.append((ref, obj.getObject()))
+            return ref
+        elif isinstance(obj, StreamObject):
+            if not topLevel:
+                # Streams always have to be indirect objects
+                ref = self.reserveObject()
+                self._pending.append((ref, obj))
+                return ref
+
+            if isinstance(obj, EncodedStreamObject):
+                copy = EncodedStreamObject()
+            else:
+                copy = DecodedStreamObject()
+            copy._data = obj._data
+            for key, value in obj.items():
+                copy[key] = self._localize(value)
+            return copy
+        elif isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                copy[key] = self._localize(value)
+            return copy
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(self._localize(value) for value in obj)
+        else:
+            return obj
+
+    def _write(self, ref, obj):
+        assert ref.idnum not in self._offsets
+        self._offsets[ref.idnum] = self.bytesWritten()
+        self._out('{} 0 obj\n'.format(ref.idnum).encode('ascii'))
+        self._outObject(obj)
+        self._out(b'\nendobj\n')
+
+    def writeObject(self, ref, obj):
+        """Writes obj as the object previously reserved as ref"""
+        self._write(ref, self._localize(obj, topLevel=True))
+        while self._pending:
+            ref, obj = self._pending.popleft()
+            self._write(ref, self._localize(obj, topLevel=True))
+
+    def addObject(self, obj):
+        ref = self.reserveObject()
+        self.writeObject(ref, obj)
+        return ref
+
+    def addPage(self, page):
+        page[NameObject('/Parent')] = self._pagesRef
+        ref = self.addObject(page)
+        self._pageRefs.append(ref)
+        return ref
+
+    def close(self):
+        """Writes the page tree, catalog, xref table and trailer"""
+        self.writeObject(self._pagesRef, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(self._pageRefs),
+            NameObject('/Count'): NumberObject(len(self._pageRefs)),
+        }))
+        rootRef = self.addObject(DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self._pagesRef,
+        }))
+        assert len(self._offsets) == self._nextId - 1
+
+        xrefOffset = self.bytesWritten()
+        xref = ['xref', '0 {}'.format(self._nextId), '0000000000 65535 f ']
+        for idnum in range(1, self._nextId):
+            xref.append('{:010d} 00000 n '.format(self._offsets[idnum]))
+        self._out(('\n'.join(xref) + '\n').encode('ascii'))
+
+        self._out(b'trailer\n')
+        self._outObject(DictionaryObject({
+            NameObject('/Size'): NumberObject(self._nextId),
+            NameObject('/Root'): rootRef,
+        }))
+        self._out('\nstartxref\n{}\n%%EOF\n'.format(
+                           xrefOffset).encode('ascii'))
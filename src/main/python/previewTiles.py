@@ -0,0 +1,150 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from lazyPixmaps import LazyPixmaps
+import math
+from PyQt5.QtCore import QPointF, QRectF, QSize, QSizeF
+from PyQt5.QtWidgets import QGraphicsItem
+
+# Size of a preview tile in device pixels
+TILE_SIZE = 256
+
+# Zoom levels are powers of two of device pixels per page unit.  Level 0 is
+# 72 DPI for PDFs.
+MIN_LEVEL = -4
+MAX_LEVEL = 5
+
+# Minimum number of tile pixmaps to keep around regardless of how few are
+# visible
+MIN_CACHED_TILES = 64
+
+def levelForScale(scale):
+    """Returns the zoom level to render at for a scale in pixels per unit"""
+    level = math.ceil(math.log2(max(scale, 2 ** MIN_LEVEL)))
+    return min(max(level, MIN_LEVEL), MAX_LEVEL)
+
+
+def _tileRect(pageRect, level, tx, ty):
+    tileUnits = TILE_SIZE / (2 ** level)
+    rect = QRectF(tx * tileUnits, ty * tileUnits, tileUnits, tileUnits)
+    return rect.intersected(pageRect)
+
+
+def _tileKeys(pageRect, level, rect):
+    tileUnits = TILE_SIZE / (2 ** level)
+    rect = rect.intersected(pageRect)
+    if rect.isEmpty():
+        return []
+
+    return [(level, tx, ty)
+            for ty in range(math.floor(rect.top() / tileUnits),
+                            math.ceil(rect.bottom() / tileUnits))
+            for tx in range(math.floor(rect.left() / tileUnits),
+                            math.ceil(rect.right() / tileUnits))]
+
+
+def _tileSizeHint(level, rect):
+    return QSize(max(2, math.ceil(rect.width() * (2 ** level))),
+                 max(2, math.ceil(rect.height() * (2 ** level))))
+
+
+def _renderTile(inputPage, sizeHint, region, progress=None):
+    # The tile may have scrolled out of view while it was queued
+    if progress and not progress(0):
+        return None
+    return inputPage.getQImage(sizeHint, region)
+
+
+def prefetchTiles(inputPage, level, rect, progress=None):
+    """Renders the tiles of inputPage a TiledPageItem would show for rect
+
+    This only fills in the page's render cache so showing the page later
+    at that zoom doesn't have to wait for them.  Returns False if it was
+    canceled part way through.
+    """
+    pageRect = QRectF(QPointF(0, 0), QSizeF(inputPage.getSize()))
+    for key in _tileKeys(pageRect, level, rect):
+        region = _tileRect(pageRect, *key)
+        if _renderTile(inputPage, _tileSizeHint(level, region), region,
+                       progress) is None:
+            return False
+    return True
+
+
+class TiledPageItem(QGraphicsItem):
+    """A QGraphicsItem which draws a page as tiles rendered for the zoom
+
+    Only the tiles which are visible in a view get rendered, at a level of
+    detail that matches the current view scale.  Rendering happens on the
+    thread pool and tiles which scroll out of view before they're rendered
+    are canceled.  Until a tile arrives, whatever is underneath the item
+    shows through, so put a low-resolution image of the page below it.
+    """
+    def __init__(self, inputPage, parent=None):
+        super(TiledPageItem, self).__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+        self._inputPage = inputPage
+        self._pageRect = QRectF(QPointF(0, 0), QSizeF(inputPage.getSize()))
+        self._tiles = LazyPixmaps(MIN_CACHED_TILES, self._tileRendered)
+
+    def cancelAll(self):
+        self._tiles.cancelAll()
+
+    def boundingRect(self):
+        return self._pageRect
+
+    def _tileRect(self, level, tx, ty):
+        return _tileRect(self._pageRect, level, tx, ty)
+
+    def _tileKeys(self, level, rect):
+        return _tileKeys(self._pageRect, level, rect)
+
+    def _visibleRect(self):
+        rect = QRectF()
+        for view in self.scene().views():
+            viewRect = view.mapToScene(view.viewport().rect()).boundingRect()
+            rect = rect.united(self.mapRectFromScene(viewRect))
+        return rect
+
+    def _requestTile(self, key):
+        if self._tiles.isPending(key):
+            return
+
+        level = key[0]
+        rect = self._tileRect(*key)
+        self._tiles.request(key, _renderTile, self._inputPage,
+                            _tileSizeHint(level, rect), rect)
+
+    def _tileRendered(self, key):
+        self.update(self._tileRect(*key))
+
+    def paint(self, painter, option, widget=None):
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        if widget is not None:
+            scale *= widget.devicePixelRatioF()
+        level = levelForScale(scale)
+
+        # Tiles for another zoom level count as out of view too
+        self._tiles.setVisible(self._tileKeys(level, self._visibleRect()))
+
+        for key in self._tileKeys(level, option.exposedRect):
+            pixmap = self._tiles.get(key)
+            if pixmap is None:
+                self._requestTile(key)
+                continue
+
+            painter.drawPixmap(self._tileRect(*key), pixmap,
+                               QRectF(pixmap.rect()))
@@ -0,0 +1,294 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import os
+from PyQt5.QtGui import QImage
+import struct
+import tempfile
+import threading
+import tracing
+import zlib
+
+DEFAULT_BYTE_BUDGET = 256 * 1024 * 1024
+
+DEFAULT_DISK_BYTE_BUDGET = 1024 * 1024 * 1024
+
+# Renders are stored as their raw pixels run through zlib.  Print-resolution
+# renders are hundreds of megabytes and encoding those as PNG takes several
+# times as long as level 1 zlib does, for about the same size since renders
+# are mostly flat color.
+DISK_CACHE_MAGIC = b'PXRC'
+DISK_CACHE_HEADER = struct.Struct('<4sIIII')
+DISK_CACHE_SUFFIX = '.qimg'
+DISK_CACHE_LEVEL = 1
+DISK_CACHE_CHUNK = 4 * 1024 * 1024
+
+def _writeImage(f, image):
+    f.write(DISK_CACHE_HEADER.pack(DISK_CACHE_MAGIC, image.width(),
+                                   image.height(), image.bytesPerLine(),
+                                   int(image.format())))
+
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    data = memoryview(bits)
+
+    # Compress a chunk at a time so we never hold a second copy
+    compressor = zlib.compressobj(DISK_CACHE_LEVEL)
+    for start in range(0, len(data), DISK_CACHE_CHUNK):
+        f.write(compressor.compress(data[start:start + DISK_CACHE_CHUNK]))
+    f.write(compressor.flush())
+
+
+def _readImage(f):
+    # Returns the QImage in f or None if it isn't one of ours
+    header = f.read(DISK_CACHE_HEADER.size)
+    if len(header) != DISK_CACHE_HEADER.size:
+        return None
+    magic, width, height, bytesPerLine, imageFormat = \
+        DISK_CACHE_HEADER.unpack(header)
+    if magic != DISK_CACHE_MAGIC:
+        return None
+
+    image = QImage(width, height, QImage.Format(imageFormat))
+    if image.isNull() or image.bytesPerLine() != bytesPerLine:
+        return None
+
+    bits = image.bits()
+    bits.setsize(image.sizeInBytes())
+    data = memoryview(bits)
+
+    # Flat renders compress hundreds of times over so the output has to be
+    # limited too or one chunk of input would inflate to the whole image
+    decompressor = zlib.decompressobj()
+    offset = 0
+    compressed = b''
+    while not decompressor.eof:
+        if not compressed:
+            compressed = f.read(DISK_CACHE_CHUNK)
+            if not compressed:
+                return None # Truncated
+        chunk = decompressor.decompress(compressed, DISK_CACHE_CHUNK)
+        compressed = decompressor.unconsumed_tail
+        if offset + len(chunk) > len(data):
+            return None
+        data[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+
+    if offset != len(data):
+        return None
+    return image
+
+
+class RenderCache(object):
+    """A least-recently-used cache of rendered QImages with a byte budget
+
+    Keys are arbitrary hashables, typically (page, resolution, region).
+    The hits and misses counters are there to help tune the budget.
+    """
+    def __init__(self, byteBudget=DEFAULT_BYTE_BUDGET):
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._bytes = 0
+        self._byteBudget = byteBudget
+        self.hits = 0
+        self.misses = 0
+
+    def _evictLocked(self):
+        while self._bytes > self._byteBudget and self._images:
+            _, image = self._images.popitem(last=False)
+            self._bytes -= image.sizeInBytes()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._bytes -= old.sizeInBytes()
+
+            # Don't throw away everything else for an image which would
+            # just get evicted again anyway.
+            if image.sizeInBytes() > self._byteBudget:
+                return
+
+            self._images[key] = image
+            self._bytes += image.sizeInBytes()
+            self._evictLocked()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def byteBudget(self):
+        return self._byteBudget
+
+    def setByteBudget(self, byteBudget):
+        with self._lock:
+            self._byteBudget = byteBudget
+            self._evictLocked()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'images': len(self._images),
+                'bytes': self._bytes,
+                'byteBudget': self._byteBudget,
+            }
+
+
+class DiskRenderCache(object):
+    """A least-recently-used cache of rendered QImages in a directory
+
+    This persists across sessions, and can be shared between processes, so
+    keys have to identify the content being rendered and not just which
+    file it came from.  When the files add up to more than byteBudget, the
+    least recently used ones are deleted.  Recency is tracked with the
+    modification time of the files so it survives restarts.
+    """
+    def __init__(self, directory, byteBudget=DEFAULT_DISK_BYTE_BUDGET):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict()
+        self._bytes = 0
+        self._byteBudget = byteBudget
+        self.hits = 0
+        self.misses = 0
+
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(DISK_CACHE_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue # Evicted by someone else
+            entries.append((st.st_mtime, name, st.st_size))
+
+        for mtime, name, size in sorted(entries):
+            self._files[name] = size
+            self._bytes += size
+
+        with self._lock:
+            self._evictLocked()
+
+    def _fileName(self, key):
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + \
+               DISK_CACHE_SUFFIX
+
+    def _evictLocked(self):
+        while self._bytes > self._byteBudget and self._files:
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _touchLocked(self, name, size):
+        old = self._files.pop(name, None)
+        if old is not None:
+            self._bytes -= old
+        self._files[name] = size
+        self._bytes += size
+
+    def get(self, key):
+        name = self._fileName(key)
+        path = os.path.join(self.directory, name)
+
+        # Another process may have put it there so always look on disk
+        with tracing.span('diskCache.load'):
+            try:
+                with open(path, 'rb') as f:
+                    image = _readImage(f)
+            except (OSError, zlib.error):
+                image = None
+
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            try:
+                os.utime(path)
+                self._touchLocked(name, os.path.getsize(path))
+            except FileNotFoundError:
+                pass
+            return image
+
+    def put(self, key, image):
+        name = self._fileName(key)
+
+        # A full disk or a read-only cache just means it doesn't get cached
+        tmpPath = None
+        try:
+            fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with tracing.span('diskCache.store'):
+                with os.fdopen(fd, 'wb') as f:
+                    _writeImage(f, image)
+            size = os.path.getsize(tmpPath)
+            if size > self._byteBudget:
+                os.remove(tmpPath)
+                return
+
+            # Renaming is atomic so nobody ever sees half a file
+            os.replace(tmpPath, os.path.join(self.directory, name))
+        except OSError:
+            if tmpPath is not None and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+
+        with self._lock:
+            self._touchLocked(name, size)
+            self._evictLocked()
+
+    def clear(self):
+        with self._lock:
+            for name in self._files:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            self._files.clear()
+            self._bytes = 0
+
+    def byteBudget(self):
+        return self._byteBudget
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'images': len(self._files),
+                'bytes': self._bytes,
+                'byteBudget': self._byteBudget,
+            }
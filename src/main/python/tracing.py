@@ -0,0 +1,191 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Timing spans around the expensive stages of rendering and export
+
+Tracing is off by default and span() costs next to nothing until it's
+turned on with enable() or by pointing the PDFXPLODE_TRACE environment
+variable at the file to write the trace to when the program exits.
+PDFXPLODE_TRACE_FORMAT picks "chrome" (the default), which can be loaded
+into chrome://tracing or Perfetto, or "json" for per-job totals and the
+raw spans.
+
+Spans are tagged with the job active on the thread that recorded them.
+Spans recorded inside worker processes are not collected.
+"""
+
+import atexit
+import collections
+import json
+import os
+import threading
+import time
+
+TRACE_ENV = 'PDFXPLODE_TRACE'
+TRACE_FORMAT_ENV = 'PDFXPLODE_TRACE_FORMAT'
+
+TRACE_FORMATS = ['chrome', 'json']
+
+_enabled = False
+_lock = threading.Lock()
+_spans = []
+_local = threading.local()
+_startTime = time.perf_counter()
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        end = time.perf_counter()
+        record = (self.name, getattr(_local, 'job', None),
+                  threading.get_ident(), self.start, end - self.start,
+                  self.args)
+        with _lock:
+            _spans.append(record)
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def isEnabled():
+    return _enabled
+
+
+def clear():
+    with _lock:
+        del _spans[:]
+
+
+def span(name, **args):
+    """Returns a context manager which times the code inside it"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+class job(object):
+    """Tags all spans recorded on this thread inside it with name"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._prev = getattr(_local, 'job', None)
+        _local.job = self.name
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        _local.job = self._prev
+        return False
+
+
+def summary():
+    """Returns {job: {span name: {'count', 'total', 'max'}}} in seconds"""
+    with _lock:
+        spans = list(_spans)
+
+    jobs = collections.OrderedDict()
+    for name, jobName, tid, start, duration, args in spans:
+        stages = jobs.setdefault(jobName, collections.OrderedDict())
+        stage = stages.setdefault(name, {'count': 0, 'total': 0, 'max': 0})
+        stage['count'] += 1
+        stage['total'] += duration
+        stage['max'] = max(stage['max'], duration)
+    return jobs
+
+
+def toChromeTrace():
+    with _lock:
+        spans = list(_spans)
+
+    pid = os.getpid()
+    events = []
+    for name, jobName, tid, start, duration, args in spans:
+        args = dict(args)
+        if jobName is not None:
+            args['job'] = jobName
+        events.append({
+            'name': name,
+            'cat': jobName or 'pdfXplode',
+            'ph': 'X',
+            'ts': (start - _startTime) * 1e6,
+            'dur': duration * 1e6,
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def toJSON():
+    with _lock:
+        spans = list(_spans)
+
+    return {
+        'summary': [{'job': jobName, 'stages': stages}
+                    for jobName, stages in summary().items()],
+        'spans': [{
+            'name': name,
+            'job': jobName,
+            'thread': tid,
+            'start': start - _startTime,
+            'duration': duration,
+            'args': args,
+        } for name, jobName, tid, start, duration, args in spans],
+    }
+
+
+def write(fileName, traceFormat='chrome'):
+    if traceFormat == 'chrome':
+        data = toChromeTrace()
+    elif traceFormat == 'json':
+        data = toJSON()
+    else:
+        raise ValueError("Unknown trace format: " + traceFormat)
+
+    with open(fileName, 'w') as f:
+        json.dump(data, f, indent=1, default=str)
+
+
+def _writeFromEnv():
+    write(os.environ[TRACE_ENV],
+          os.environ.get(TRACE_FORMAT_ENV, 'chrome'))
+
+
+if os.environ.get(TRACE_ENV):
+    enable()
+    atexit.register(_writeFromEnv)
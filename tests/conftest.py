@@ -0,0 +1,105 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import sys
+
+# The modules are run flat out of the source directory, not installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'main', 'python'))
+
+import PyPDF2
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+)
+import pytest
+
+def name(value):
+    return NameObject(value)
+
+
+def dictionary(entries):
+    """Builds a DictionaryObject from a dict with plain string keys"""
+    return DictionaryObject({NameObject(k): v for k, v in entries.items()})
+
+
+def numbers(values):
+    return ArrayObject(NumberObject(v) for v in values)
+
+
+class PDFBuilder(object):
+    """Builds small PDFs with PyPDF2 for the tests to read back"""
+    def __init__(self):
+        self.writer = PyPDF2.PdfFileWriter()
+
+    def indirect(self, obj):
+        return self.writer._addObject(obj)
+
+    def stream(self, data, entries={}):
+        stream = DecodedStreamObject()
+        stream.setData(data)
+        stream.update(dictionary(entries))
+        return self.indirect(stream)
+
+    def font(self, baseFont='/Helvetica'):
+        return self.indirect(dictionary({
+            '/Type': name('/Font'),
+            '/Subtype': name('/Type1'),
+            '/BaseFont': name(baseFont),
+        }))
+
+    def form(self, content, bbox):
+        return self.stream(content, {
+            '/Type': name('/XObject'),
+            '/Subtype': name('/Form'),
+            '/BBox': numbers(bbox),
+        })
+
+    def addPage(self, width, height, content=None, resources=None):
+        """Adds a page.  resources is a dict of plain string keys."""
+        page = self.writer.addBlankPage(width, height)
+        if content is not None:
+            page[NameObject('/Contents')] = self.stream(content)
+        if resources is not None:
+            page[NameObject('/Resources')] = dictionary(resources)
+        return page
+
+    def getvalue(self):
+        out = io.BytesIO()
+        self.writer.write(out)
+        return out.getvalue()
+
+    def save(self, fileName):
+        with open(fileName, 'wb') as f:
+            f.write(self.getvalue())
+
+    def reader(self):
+        return PyPDF2.PdfFileReader(io.BytesIO(self.getvalue()))
+
+
+def readPDF(fileName):
+    """Reads fileName back with PyPDF2 without leaving it open"""
+    with open(fileName, 'rb') as f:
+        return PyPDF2.PdfFileReader(io.BytesIO(f.read()))
+
+
+@pytest.fixture
+def pdfBuilder():
+    return PDFBuilder()
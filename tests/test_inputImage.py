@@ -0,0 +1,98 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from inputImage import _readJPEGInfo, JPEGInfo
+import io
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QColor, QImage
+import pytest
+import struct
+
+def segment(marker, data):
+    return struct.pack('>BBH', 0xff, marker, len(data) + 2) + data
+
+
+def frame(marker=0xc0, bits=8, height=30, width=40, components=3):
+    data = struct.pack('>BHHB', bits, height, width, components)
+    data += b''.join(struct.pack('>BBB', i + 1, 0x11, 0)
+                     for i in range(components))
+    return segment(marker, data)
+
+
+JFIF = segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+ADOBE = segment(0xee, b'Adobe\x00\x64\x00\x00\x00\x00\x02')
+HUFFMAN = segment(0xc4, b'\x00' + b'\x00' * 16)
+
+def readInfo(data):
+    return _readJPEGInfo(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('marker', [0xc0, 0xc1, 0xc2])
+def testFrame(marker):
+    data = b'\xff\xd8' + JFIF + HUFFMAN + frame(marker)
+    assert readInfo(data) == JPEGInfo(40, 30, 3, False)
+
+
+@pytest.mark.parametrize('components', [1, 3, 4])
+def testComponents(components):
+    data = b'\xff\xd8' + frame(components=components)
+    assert readInfo(data).components == components
+
+
+def testAdobe():
+    data = b'\xff\xd8' + ADOBE + frame(components=4)
+    assert readInfo(data) == JPEGInfo(40, 30, 4, True)
+
+
+def testFillBytes():
+    data = b'\xff\xd8' + JFIF + b'\xff\xff' + frame()[1:]
+    assert readInfo(data) == JPEGInfo(40, 30, 3, False)
+
+
+@pytest.mark.parametrize('marker', [
+    0xc3,       # Lossless
+    0xc5, 0xc6, # Differential
+    0xc9, 0xca, # Arithmetic coded
+])
+def testUnsupportedFrame(marker):
+    assert readInfo(b'\xff\xd8' + frame(marker)) is None
+
+
+def testTwelveBit():
+    assert readInfo(b'\xff\xd8' + frame(bits=12)) is None
+
+
+def testTwoComponents():
+    assert readInfo(b'\xff\xd8' + frame(components=2)) is None
+
+
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 5, 12, 25])
+def testTruncated(length):
+    data = b'\xff\xd8' + JFIF + frame()
+    assert readInfo(data[:length]) is None
+
+
+def testNotJPEG():
+    assert readInfo(b'\x89PNG\r\n\x1a\n' + b'\x00' * 32) is None
+
+
+def testQtJPEG():
+    image = QImage(40, 30, QImage.Format_RGB32)
+    image.fill(QColor(200, 100, 50))
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    assert image.save(buf, 'JPEG')
+    assert readInfo(bytes(data)) == JPEGInfo(40, 30, 3, False)
@@ -0,0 +1,95 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from conftest import dictionary, readPDF
+import io
+import os
+from pdfBackend import availableBackends, BACKENDS, getBackend
+import PyPDF2
+from PyPDF2.generic import FloatObject
+import pytest
+
+SOURCE_CONTENT = b'/GS0 gs /F1 12 Tf BT 10 10 Td (Hi) Tj ET'
+
+class _SourceFile(object):
+    # Just what the writers use of an InputPDFFile, so this doesn't need
+    # poppler
+    def __init__(self, data):
+        self.bytes = data
+        self.reader = PyPDF2.PdfFileReader(io.BytesIO(data))
+
+    def getBackendDocument(self, backend):
+        return backend.openDocument(io.BytesIO(self.bytes))
+
+
+class _SourcePage(object):
+    def __init__(self, pdfFile, pageNumber):
+        self.pdfFile = pdfFile
+        self.pageNumber = pageNumber
+
+    def getPyPDF2PageObject(self):
+        return self.pdfFile.reader.getPage(self.pageNumber - 1)
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    if request.param not in availableBackends():
+        pytest.skip(request.param + " is not installed")
+    return getBackend(request.param)
+
+
+@pytest.fixture
+def exploded(backend, pdfBuilder, tmp_path):
+    # One page whose /Resources is a direct dictionary, which is how most
+    # PDFs have it, holding both direct and indirect objects
+    pdfBuilder.addPage(200, 300, SOURCE_CONTENT, {
+        '/ExtGState': dictionary({
+            '/GS0': dictionary({'/CA': FloatObject(0.5)}),
+        }),
+        '/Font': dictionary({'/F1': pdfBuilder.font()}),
+    })
+    source = _SourcePage(_SourceFile(pdfBuilder.getvalue()), 1)
+
+    fileName = str(tmp_path / 'out.pdf')
+    writer = backend.openWriter(fileName)
+    xobject = writer.addPageXObject(source)
+    writer.addPage(100, 150, b'q 1 0 0 1 -50 -75 cm /Src Do Q',
+                   {'/Src': xobject})
+    writer.close()
+    assert writer.bytesWritten() == os.path.getsize(fileName)
+    return readPDF(fileName)
+
+
+def _sourceForm(reader):
+    return reader.getPage(0)['/Resources']['/XObject']['/Src'].getObject()
+
+
+def testPageXObject(exploded):
+    assert exploded.getNumPages() == 1
+
+    page = exploded.getPage(0)
+    assert [float(v) for v in page.mediaBox] == [0, 0, 100, 150]
+    form = _sourceForm(exploded)
+    assert form['/Subtype'] == '/Form'
+    assert [float(v) for v in form['/BBox']] == [0, 0, 200, 300]
+    assert form.getData().strip() == SOURCE_CONTENT
+
+
+def testDirectResources(exploded):
+    resources = _sourceForm(exploded)['/Resources'].getObject()
+    gs = resources['/ExtGState']['/GS0'].getObject()
+    assert float(gs['/CA']) == 0.5
+    font = resources['/Font']['/F1'].getObject()
+    assert font['/BaseFont'] == '/Helvetica'
@@ -0,0 +1,106 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from conftest import dictionary
+from pdfCull import CullableContents, parseContents
+from PyPDF2.generic import DecodedStreamObject
+from PyPDF2.pdf import ContentStream
+import pytest
+
+# A 400x400 page with something in each corner, a stroked line through
+# the middle and a Form XObject.  Everything but the blue square is well
+# clear of CORNER.
+PAGE_CONTENT = b'\n'.join([
+    b'q 0 0 1 rg 10 10 50 50 re f Q',
+    b'q 1 0 0 rg 300 300 50 50 re f Q',
+    b'q 1 0 0 1 200 0 cm 2 w 0 200 m 100 200 l S Q',
+    b'BT /F1 12 Tf 20 370 Td (Hello) Tj ET',
+    b'q 1 0 0 1 350 10 cm /Fm0 Do Q',
+])
+CORNER = (0, 0, 100, 100)
+
+@pytest.fixture
+def cullable(pdfBuilder):
+    """Returns a function which makes a page of content cullable
+
+    It returns the PdfFileReader the page was read back with, its parsed
+    operations and the CullableContents.
+    """
+    def cullable(content):
+        pdfBuilder.addPage(400, 400, content, {
+            '/Font': dictionary({'/F1': pdfBuilder.font()}),
+            '/XObject': dictionary({
+                '/Fm0': pdfBuilder.form(b'0 0 10 10 re f', (0, 0, 10, 10)),
+            }),
+        })
+        reader = pdfBuilder.reader()
+        page = reader.getPage(0)
+        ops = parseContents(reader, page)
+        return reader, ops, CullableContents(reader, ops, page['/Resources'])
+    return cullable
+
+
+def operators(reader, data):
+    stream = DecodedStreamObject()
+    stream.setData(data)
+    ops = ContentStream(stream, reader).operations
+    return [operator for _, operator in ops]
+
+
+def testWholePage(cullable):
+    reader, ops, contents = cullable(PAGE_CONTENT)
+    culled = contents.cull((0, 0, 400, 400))
+    assert operators(reader, culled) == [operator for _, operator in ops]
+
+    # The same as PyPDF2 would write it
+    original = DecodedStreamObject()
+    original.setData(PAGE_CONTENT)
+    assert culled == ContentStream(original, reader).getData()
+
+
+def testCorner(cullable):
+    reader, ops, contents = cullable(PAGE_CONTENT)
+    culled = operators(reader, contents.cull(CORNER))
+
+    # Only the blue square is painted but all of the state is kept
+    assert culled.count(b'f') == 1
+    assert culled.count(b're') == 1
+    assert b'S' not in culled
+    assert b'Tj' not in culled
+    assert b'Do' not in culled
+    assert culled.count(b'q') == 4
+    assert culled.count(b'Q') == 4
+    assert culled.count(b'cm') == 2
+    assert b'Tf' in culled
+
+
+def testDependentText(cullable):
+    # The second string starts where the first leaves off so the first
+    # can't go, even though it's out of view.  The last one can.
+    reader, ops, contents = cullable(
+        b'BT /F1 12 Tf 20 370 Td (A) Tj (B) Tj ET')
+    culled = operators(reader, contents.cull(CORNER))
+    assert culled.count(b'Tj') == 1
+
+    culled = operators(reader, contents.cull((0, 300, 100, 400)))
+    assert culled.count(b'Tj') == 2
+
+
+def testNewLineShow(cullable):
+    # ' moves to the next line even when it's dropped
+    reader, ops, contents = cullable(b"BT /F1 12 Tf 14 TL 20 370 Td (A) ' ET")
+    culled = operators(reader, contents.cull(CORNER))
+    assert b"'" not in culled
+    assert b'T*' in culled
@@ -0,0 +1,98 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from conftest import dictionary, readPDF
+import os
+from pdfOptimize import optimizePDF
+import pytest
+
+# Long enough to be worth compressing
+FORM_CONTENT = b'0 0 m 100 100 l S\n' * 20
+OTHER_FORM_CONTENT = b'0 100 m 100 0 l S\n' * 20
+FORM_CONTENTS = [FORM_CONTENT, FORM_CONTENT, OTHER_FORM_CONTENT]
+
+def pageContent(pageNumber):
+    return '/Fm0 Do BT /F1 12 Tf 10 10 Td (Page {}) Tj ET\n'.format(
+               pageNumber).encode('ascii') * 10
+
+
+@pytest.fixture
+def inFileName(pdfBuilder, tmp_path):
+    # One page per form.  Every page gets its own copy of its form and its
+    # font, the way a PDF exploded from the same page over and over does.
+    for pageNumber, formContent in enumerate(FORM_CONTENTS, 1):
+        pdfBuilder.addPage(200, 200, pageContent(pageNumber), {
+            '/Font': dictionary({'/F1': pdfBuilder.font()}),
+            '/XObject': dictionary({
+                '/Fm0': pdfBuilder.form(formContent, (0, 0, 100, 100)),
+            }),
+        })
+    fileName = str(tmp_path / 'in.pdf')
+    pdfBuilder.save(fileName)
+    return fileName
+
+
+@pytest.fixture
+def optimized(inFileName, tmp_path):
+    """Returns the bytes saved and the optimized PDF read back"""
+    outFileName = str(tmp_path / 'out.pdf')
+    inSize = os.path.getsize(inFileName)
+    saved = optimizePDF(inFileName, outFileName)
+    assert saved == inSize - os.path.getsize(outFileName)
+    return saved, readPDF(outFileName)
+
+
+def formRef(page):
+    return page['/Resources']['/XObject'].raw_get('/Fm0')
+
+
+def testContent(optimized):
+    saved, reader = optimized
+    assert saved > 0
+    assert reader.getNumPages() == 3
+    for i in range(3):
+        page = reader.getPage(i)
+        assert [float(v) for v in page.mediaBox] == [0, 0, 200, 200]
+        contents = page.getContents()
+        assert contents['/Filter'] == '/FlateDecode'
+        assert contents.getData() == pageContent(i + 1)
+
+        form = formRef(page).getObject()
+        assert form['/Subtype'] == '/Form'
+        assert form.getData() == FORM_CONTENTS[i]
+
+
+def testDedupe(optimized):
+    saved, reader = optimized
+    pages = [reader.getPage(i) for i in range(3)]
+
+    # The identical forms become one and so do all the fonts
+    assert formRef(pages[0]).idnum == formRef(pages[1]).idnum
+    assert formRef(pages[0]).idnum != formRef(pages[2]).idnum
+    fonts = set(page['/Resources']['/Font'].raw_get('/F1').idnum
+                for page in pages)
+    assert len(fonts) == 1
+
+
+def testNoSavings(inFileName, tmp_path):
+    # Optimizing again can't do any better so it's copied as-is
+    optimizePDF(inFileName)
+    with open(inFileName, 'rb') as f:
+        optimized = f.read()
+
+    outFileName = str(tmp_path / 'out.pdf')
+    assert optimizePDF(inFileName, outFileName) == 0
+    with open(outFileName, 'rb') as f:
+        assert f.read() == optimized
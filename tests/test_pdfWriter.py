@@ -0,0 +1,87 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from conftest import dictionary, name, numbers
+import io
+from pdfWriter import StreamingPDFWriter
+import PyPDF2
+from PyPDF2.generic import DecodedStreamObject, NumberObject
+import pytest
+
+def pageContent(pageNumber):
+    return 'BT /F1 12 Tf 10 10 Td (Page {}) Tj ET'.format(
+               pageNumber).encode('ascii')
+
+
+def makePage(content, resources):
+    stream = DecodedStreamObject()
+    stream.setData(content)
+    return dictionary({
+        '/Type': name('/Page'),
+        '/MediaBox': numbers((0, 0, 300, 200)),
+        '/Contents': stream,
+        '/Resources': dictionary(resources),
+    })
+
+
+@pytest.fixture
+def written(pdfBuilder):
+    # Three pages which all use a font imported from another PDF
+    pdfBuilder.addPage(100, 100, None,
+                       {'/Font': dictionary({'/F1': pdfBuilder.font()})})
+    source = pdfBuilder.reader()
+    fontRef = source.getPage(0)['/Resources']['/Font'].raw_get('/F1')
+
+    out = io.BytesIO()
+    writer = StreamingPDFWriter(out)
+    for pageNumber in range(1, 4):
+        writer.addPage(makePage(pageContent(pageNumber),
+                                {'/Font': dictionary({'/F1': fontRef})}))
+    assert writer.getNumPages() == 3
+    writer.close()
+
+    data = out.getvalue()
+    assert writer.bytesWritten() == len(data)
+    return PyPDF2.PdfFileReader(io.BytesIO(data))
+
+
+def testPages(written):
+    assert written.getNumPages() == 3
+    for i in range(3):
+        page = written.getPage(i)
+        assert [float(v) for v in page.mediaBox] == [0, 0, 300, 200]
+        assert page.getContents().getData() == pageContent(i + 1)
+
+
+def testImportedOnce(written):
+    fonts = [written.getPage(i)['/Resources']['/Font'].raw_get('/F1')
+             for i in range(3)]
+    assert len(set(ref.idnum for ref in fonts)) == 1
+    assert fonts[0].getObject()['/BaseFont'] == '/Helvetica'
+
+
+def testReservedObject():
+    # Pages can point at objects which are only written afterwards
+    out = io.BytesIO()
+    writer = StreamingPDFWriter(out)
+    ref = writer.reserveObject()
+    writer.addPage(makePage(b'/GS0 gs',
+                            {'/ExtGState': dictionary({'/GS0': ref})}))
+    writer.writeObject(ref, dictionary({'/CA': NumberObject(1)}))
+    writer.close()
+
+    reader = PyPDF2.PdfFileReader(io.BytesIO(out.getvalue()))
+    gs = reader.getPage(0)['/Resources']['/ExtGState']['/GS0']
+    assert gs.getObject()['/CA'] == 1
@@ -0,0 +1,137 @@
+# Copyright © 2020 Jason Ekstrand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from PyQt5.QtGui import QColor, QImage
+import pytest
+from renderCache import DISK_CACHE_SUFFIX, DiskRenderCache, RenderCache
+
+# 10x10 ARGB32 images are 400 bytes each
+IMAGE_BYTES = 400
+
+def makeImage(color=QColor(255, 0, 0), size=10):
+    image = QImage(size, size, QImage.Format_ARGB32)
+    image.fill(color)
+    return image
+
+
+def testGetPut():
+    cache = RenderCache(10 * IMAGE_BYTES)
+    image = makeImage()
+    assert cache.get('a') is None
+    cache.put('a', image)
+    assert cache.get('a') is image
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def testLRU():
+    cache = RenderCache(2 * IMAGE_BYTES)
+    cache.put('a', makeImage())
+    cache.put('b', makeImage())
+    cache.get('a')
+    cache.put('c', makeImage())
+
+    # b was used least recently
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.stats()['bytes'] == 2 * IMAGE_BYTES
+
+
+def testReplace():
+    cache = RenderCache(2 * IMAGE_BYTES)
+    cache.put('a', makeImage())
+    cache.put('a', makeImage())
+    assert cache.stats()['images'] == 1
+    assert cache.stats()['bytes'] == IMAGE_BYTES
+
+
+def testTooBig():
+    # An image which could never fit doesn't push everything else out
+    cache = RenderCache(2 * IMAGE_BYTES)
+    cache.put('a', makeImage())
+    cache.put('big', makeImage(size=20))
+    assert cache.get('big') is None
+    assert cache.get('a') is not None
+
+
+def testSetByteBudget():
+    cache = RenderCache(3 * IMAGE_BYTES)
+    for key in 'abc':
+        cache.put(key, makeImage())
+    cache.setByteBudget(IMAGE_BYTES)
+    assert cache.stats()['images'] == 1
+    assert cache.get('c') is not None
+
+
+def _cacheFiles(directory):
+    return [name for name in os.listdir(directory)
+            if name.endswith(DISK_CACHE_SUFFIX)]
+
+
+def testDiskRoundTrip(tmp_path):
+    cache = DiskRenderCache(str(tmp_path))
+    image = makeImage(QColor(10, 20, 30, 40), size=37)
+    cache.put(('file', 1, 37, 37), image)
+
+    loaded = cache.get(('file', 1, 37, 37))
+    assert loaded.size() == image.size()
+    assert loaded.format() == image.format()
+    assert loaded == image
+    assert cache.get(('file', 2, 37, 37)) is None
+
+
+def testDiskLRU(tmp_path):
+    cache = DiskRenderCache(str(tmp_path))
+    cache.put('a', makeImage())
+    entryBytes = cache.stats()['bytes']
+
+    cache = DiskRenderCache(str(tmp_path), 2 * entryBytes)
+    cache.put('b', makeImage())
+    cache.get('a')
+    cache.put('c', makeImage())
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert len(_cacheFiles(str(tmp_path))) == 2
+
+
+def testDiskBudgetOnOpen(tmp_path):
+    cache = DiskRenderCache(str(tmp_path))
+    for key in 'abc':
+        cache.put(key, makeImage())
+    entryBytes = cache.stats()['bytes'] // 3
+
+    # Reopening with a smaller budget trims the directory down to it
+    cache = DiskRenderCache(str(tmp_path), entryBytes)
+    assert cache.stats()['images'] == 1
+    assert len(_cacheFiles(str(tmp_path))) == 1
+
+
+def testDiskTooBig(tmp_path):
+    cache = DiskRenderCache(str(tmp_path), 1)
+    cache.put('a', makeImage())
+    assert cache.get('a') is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def testDiskCorrupt(tmp_path):
+    cache = DiskRenderCache(str(tmp_path))
+    cache.put('a', makeImage())
+    name, = _cacheFiles(str(tmp_path))
+    with open(os.path.join(str(tmp_path), name), 'r+b') as f:
+        f.truncate(30)
+    assert cache.get('a') is None